@@ -1,224 +1,388 @@
-import os
-import traceback
-
-import AudioFiles
-import Media
-
-debug = False
-logfile = []
-if(debug):
-   # During debugging, we just append to a fixed file path. Change this to something appropriate for your
-   # system if needed.
-   logfile.append(open('/volume1/Plex/Library/Application Support/Plex Media Server/Logs/custom_scanner.log', 'a'))
-
-
-def log(message):
-   if(debug):
-      logfile[0].write('{0}\n'.format(message))
-
-
-def FLACCueParse(path, files, mediaList, subdirs, language=None, root=None):
-   cues = []
-   for f in files:
-      if(os.path.splitext(f)[1] == '.cue'):
-         cues.append(f)
-   for cue in cues:
-      log(cue)
-      try:
-         # Get the Cue sheet info.
-         info = read_cue(cue)
-         log(info)
-         # Get all files mentioned in the Cue sheet.
-         cuefiles = info['Files']
-         # Get the album information.
-         album = info['TITLE']
-         album_artist = AudioFiles.cleanPass(info['PERFORMER'])
-         if(album_artist == ''):
-            # No listed album artist. Use the artist from the first
-            # track of the first file.
-            try:
-               first_file = list(cuefiles.keys())[0]
-               album_artist = cuefiles[first_file]['Tracks'][1]['PERFORMER']
-            except KeyError:
-               album_artist = 'Unknown'
-         # Get the directory the files should be in. This should be
-         # the same as the Cue sheet directory.
-         folder = os.path.dirname(cue)
-         for file in cuefiles:
-            # Get the full file path.
-            full_file = os.path.join(folder, file)
-            if(not os.path.exists(full_file)):
-               continue
-
-            # My cue files include "Disc 1", "Disc 2", and similar as the
-            # final part of the title for multi-disk sets. Something like:
-            # "Artist - Album Title Disc 3.cue"
-            # The scanner is designed to pull disc information from this
-            # and to group albums together.
-
-            # Get the name of the cue file without the extension.
-            # Split it for white space.
-            try:
-               file_details = os.path.splitext(file)[-2].split()
-               # Check for disc numbering.
-               if(file_details[-2] == 'Disc'):
-                  disc = int(file_details[-1])
-               else:
-                  disc = 1
-            except IndexError:
-               disc = 1
-
-            try:
-               # Add the full file.
-               # Number it as track -1.
-               track = -1
-               # Call this "Album Name - Disc #" in the track listing
-               # Ensure the info is added cleanly.
-               title = '{0} - Disc {1}'.format(album, disc)
-               title = AudioFiles.cleanPass(title)
-               artist = AudioFiles.cleanPass(album_artist)
-               # Create the track object.
-               # Use disc 9999 to group all the full discs together. Use
-               # the disc number as the track number.
-               track_object = Media.Track(artist, album, title, disc,
-                                          disc=9999, album_artist=album_artist,
-                                          guid=None, album_guid=None)
-               # Use the file for playback.
-               track_object.parts.append(full_file)
-               log(track_object)
-               # Add the track object to the output list.
-               mediaList.append(track_object)
-
-               # Split into tracks.
-               track_info = cuefiles[file]['Tracks']
-               start_time = '00:00:00'
-               end_time = '00:00:00'
-               # Handle each track.
-               for track in track_info:
-                  title = AudioFiles.cleanPass(track_info[track]['TITLE'])
-                  try:
-                     artist = AudioFiles.cleanPass(track_info[track]['PERFORMER'])
-                  except KeyError:
-                     # No track artist specified. Use the album artist.
-                     artist = album_artist
-                  try:
-                     # Get the start time of the track.
-                     start_time = track_info[track]['INDEX'][1]
-                  except KeyError:
-                     # If none is listed, use the previous end time.
-                     start_time = end_time
-                  try:
-                     # Get the start time of the following track.
-                     # Use this as the end time for the current track.
-                     end_time = track_info[track+1]['INDEX'][1]
-                  except (IndexError, KeyError):
-                     # For the last track, we specify -1 to indicate the end of file.
-                     end_time = '-1'
-                  # Create the track object.
-                  track_object = Media.Track(artist, album, title, track,
-                                             disc=disc, album_artist=album_artist,
-                                             guid=None, album_guid=None)
-                  # Use a file format for compatibility with the FLACCue
-                  # FUSE (Filesystem in Userspace) code.
-                  # This will be something like:
-                  # /flaccue/Music/Artist/Album/Artist - Album Disc 1.flaccuesplit.10:25:17.12:55:20.flac
-                  parsed_filename = '/flaccue'+full_file+'.flaccuesplit.{}.{}.wav'.format(start_time, end_time)
-                  track_object.parts.append(parsed_filename)
-                  log(track_object)
-                  # Add the track to the returned object list.
-                  mediaList.append(track_object)
-               log('')
-               # Remove the FLAC file from the list to parse.
-               files.remove(full_file)
-            except:
-               log(traceback.format_exc())
-      except:
-         log(traceback.format_exc())
-      finally:
-         files.remove(cue)
-
-
-def read_cue(file):
-   """Parse the Cue sheet to get the desired info.
-   """
-   # Read the full Cue file.
-   with open(file, 'r') as f:
-      lines = f.readlines()
-   cue = {}
-   cue['Files'] = {}
-   # Line index. We don't use a for loop as we will
-   # read multiple lines for information.
-   i = 0
-   lenlines = len(lines)
-   try:
-      while(True):
-         # We have a FILE specification in the Cue sheet.
-         if(lines[i].startswith('FILE')):
-            # Get the filename.
-            filename = AudioFiles.cleanPass(lines[i].split('"')[1])
-            # Now we will parse the tracks from the file.
-            # Use a local variable name for clarity.
-            file_details = {}
-            # But store that variable in the cue sheet parse dictionary.
-            cue['Files'][filename] = file_details
-            # Create the Track entry to store tracks from the file.
-            file_details['Tracks'] = {}
-            # Start at the next line.
-            i += 1
-            # Use the Cue sheet indentation for sectioning. 2 spaces for
-            # TRACK entries in the FILE entry.
-            while(lines[i].startswith(' '*2)):
-               # Get rid of extra white space.
-               line = lines[i].strip()
-               # Handle TRACK entries.
-               if(line.startswith('TRACK')):
-                  # Get the track number.
-                  track = int(line.split()[1])
-                  # Use a local variable name for clarity.
-                  track_details = {}
-                  # But store that variable in the cue sheet parse dictionary.
-                  file_details['Tracks'][track] = track_details
-                  # Create the INDEX dictionary to store track indices.
-                  track_details['INDEX'] = {}
-                  # Start at the next line.
-                  i += 1
-                  # Use the Cue sheet indentation for sectioning. 4 spaces
-                  # for INDEX entries in the TRACK entry.
-                  while(lines[i].startswith(' '*4)):
-                     # Get rid of extra white space.
-                     line = lines[i].strip()
-                     # Find the index entries.
-                     if(line.startswith('INDEX')):
-                        # Remove the INDEX text and extra white space.
-                        line = line[5:].strip()
-                        # Get the INDEX number and the rest of the line.
-                        # The rest of the line should be the time information.
-                        key, value = line.split(None, 1)
-                        # Store the time information for this index.
-                        track_details['INDEX'][int(key)] = value.strip().replace('"', '')
-                        i += 1
-                     else:
-                        # Store all the other entries as text. Use the first
-                        # word as the access key.
-                        key, value = line.split(None, 1)
-                        # Also remove quotes from track names and similar.
-                        track_details[key] = value.strip().replace('"', '')
-                        i += 1
-               else:
-                  # Store all the other entries as text. Use the first
-                  # word as the access key.
-                  key, value = lines[i].split(None, 1)
-                  # Also remove quotes from track names and similar.
-                  file_details[key] = value.strip().replace('"', '')
-                  i += 1
-         else:
-            # Store all the other entries as text. Use the first
-            # word as the access key.
-            key, value = lines[i].split(None, 1)
-            # Also remove quotes from track names and similar.
-            cue[key] = value.strip().replace('"', '')
-            i += 1
-   except IndexError:
-      # We're done.
-      pass
-   return cue
+import hashlib
+import json
+import os
+import tempfile
+import traceback
+
+import AudioFiles
+import Media
+
+debug = False
+logfile = []
+if(debug):
+   # During debugging, we just append to a fixed file path. Change this to something appropriate for your
+   # system if needed.
+   logfile.append(open('/volume1/Plex/Library/Application Support/Plex Media Server/Logs/custom_scanner.log', 'a'))
+
+
+# The directory the FLACCue filesystem writes its manifests to (its
+# --manifest-dir option). Cue sheets with an up to date manifest entry are
+# not parsed again. Set this to None to always parse the Cue sheets.
+manifest_dir = '/var/packages/FLACCue/var/manifests'
+
+# The directory used to store the tracks found for each Cue sheet between
+# scans. Unchanged Cue sheets reuse these. Set this to None to disable.
+if('PLEX_MEDIA_SERVER_APPLICATION_SUPPORT_DIR' in os.environ):
+   scan_cache_dir = os.path.join(os.environ['PLEX_MEDIA_SERVER_APPLICATION_SUPPORT_DIR'],
+                                 'Plex Media Server', 'Cache', 'FLACCue')
+else:
+   scan_cache_dir = os.path.join(tempfile.gettempdir(), 'FLACCue')
+
+
+def log(message):
+   if(debug):
+      logfile[0].write('{0}\n'.format(message))
+
+
+def FLACCueParse(path, files, mediaList, subdirs, language=None, root=None):
+   cues = []
+   for f in files:
+      if(os.path.splitext(f)[1] == '.cue'):
+         cues.append(f)
+   for cue in cues:
+      log(cue)
+      try:
+         # Unchanged Cue sheets reuse the tracks from the last scan.
+         cached = read_scan_cache(cue)
+         if(cached is None):
+            tracks, handled, complete = scan_cue(cue)
+            # Don't cache failures so the next scan tries again.
+            if(complete):
+               write_scan_cache(cue, tracks, handled)
+         else:
+            log('Using cached tracks.')
+            tracks, handled = cached
+         for artist, album, title, track, disc, album_artist, part in tracks:
+            # Create the track object.
+            track_object = Media.Track(artist, album, title, track,
+                                       disc=disc, album_artist=album_artist,
+                                       guid=None, album_guid=None)
+            track_object.parts.append(part)
+            log(track_object)
+            # Add the track object to the output list.
+            mediaList.append(track_object)
+         for full_file in handled:
+            # Remove the FLAC file from the list to parse.
+            try:
+               files.remove(full_file)
+            except ValueError:
+               pass
+      except:
+         log(traceback.format_exc())
+      finally:
+         files.remove(cue)
+
+
+def scan_cue(cue):
+   """Get the tracks to create for a Cue sheet.
+
+   Returns a list of the Media.Track inputs for each track as
+   [artist, album, title, track, disc, album_artist, part], the list
+   of audio files handled by the Cue sheet, and whether every audio
+   file was scanned without errors.
+   """
+   tracks = []
+   handled = []
+   complete = True
+   # Get the Cue sheet info. Use the FLACCue manifest when available.
+   info = read_manifest(cue)
+   if(info is None):
+      info = read_cue(cue)
+   log(info)
+   # Get all files mentioned in the Cue sheet.
+   cuefiles = info['Files']
+   # Get the album information.
+   album = info['TITLE']
+   album_artist = AudioFiles.cleanPass(info['PERFORMER'])
+   if(album_artist == ''):
+      # No listed album artist. Use the artist from the first
+      # track of the first file.
+      try:
+         first_file = list(cuefiles.keys())[0]
+         album_artist = cuefiles[first_file]['Tracks'][1]['PERFORMER']
+      except KeyError:
+         album_artist = 'Unknown'
+   # Get the directory the files should be in. This should be
+   # the same as the Cue sheet directory.
+   folder = os.path.dirname(cue)
+   for file in cuefiles:
+      # Get the full file path.
+      full_file = os.path.join(folder, file)
+      if(not os.path.exists(full_file)):
+         continue
+
+      # My cue files include "Disc 1", "Disc 2", and similar as the
+      # final part of the title for multi-disk sets. Something like:
+      # "Artist - Album Title Disc 3.cue"
+      # The scanner is designed to pull disc information from this
+      # and to group albums together.
+
+      # Get the name of the cue file without the extension.
+      # Split it for white space.
+      try:
+         file_details = os.path.splitext(file)[-2].split()
+         # Check for disc numbering.
+         if(file_details[-2] == 'Disc'):
+            disc = int(file_details[-1])
+         else:
+            disc = 1
+      except IndexError:
+         disc = 1
+
+      try:
+         file_tracks = []
+         # Add the full file.
+         # Number it as track -1.
+         track = -1
+         # Call this "Album Name - Disc #" in the track listing
+         # Ensure the info is added cleanly.
+         title = '{0} - Disc {1}'.format(album, disc)
+         title = AudioFiles.cleanPass(title)
+         artist = AudioFiles.cleanPass(album_artist)
+         # Use disc 9999 to group all the full discs together. Use
+         # the disc number as the track number. Use the file for playback.
+         file_tracks.append([artist, album, title, disc, 9999, album_artist, full_file])
+
+         # Split into tracks.
+         track_info = cuefiles[file]['Tracks']
+         start_time = '00:00:00'
+         end_time = '00:00:00'
+         # Handle each track.
+         for track in track_info:
+            title = AudioFiles.cleanPass(track_info[track]['TITLE'])
+            try:
+               artist = AudioFiles.cleanPass(track_info[track]['PERFORMER'])
+            except KeyError:
+               # No track artist specified. Use the album artist.
+               artist = album_artist
+            try:
+               # Get the start time of the track.
+               start_time = track_info[track]['INDEX'][1]
+            except KeyError:
+               # If none is listed, use the previous end time.
+               start_time = end_time
+            try:
+               # Get the start time of the following track.
+               # Use this as the end time for the current track.
+               end_time = track_info[track+1]['INDEX'][1]
+            except (IndexError, KeyError):
+               # For the last track, we specify -1 to indicate the end of file.
+               end_time = '-1'
+            # Use a file format for compatibility with the FLACCue
+            # FUSE (Filesystem in Userspace) code.
+            # This will be something like:
+            # /flaccue/Music/Artist/Album/Artist - Album Disc 1.flaccuesplit.10:25:17.12:55:20.flac
+            parsed_filename = '/flaccue'+full_file+'.flaccuesplit.{}.{}.wav'.format(start_time, end_time)
+            file_tracks.append([artist, album, title, track, disc, album_artist, parsed_filename])
+         log('')
+         tracks.extend(file_tracks)
+         handled.append(full_file)
+      except:
+         log(traceback.format_exc())
+         complete = False
+   return tracks, handled, complete
+
+
+def unicode_path(path):
+   """Get a path as unicode to compare with the strings read from JSON."""
+   return path if isinstance(path, type(u'')) else path.decode('utf-8')
+
+
+def native_path(path):
+   """Get a path read from JSON as a native string to join with other paths."""
+   return path if isinstance(path, str) else path.encode('utf-8')
+
+
+def native_text(text):
+   """Get text read from JSON as a native string like the ones read_cue returns.
+
+   None is kept for missing values.
+   """
+   return None if text is None else native_path(text)
+
+
+def scan_cache_file(cue):
+   """Get the filename of the scan cache entry for a Cue sheet."""
+   key = cue.encode('utf-8') if isinstance(cue, type(u'')) else cue
+   return os.path.join(scan_cache_dir, hashlib.md5(key).hexdigest() + '.json')
+
+
+def scan_cache_key(cue):
+   """Get the details that must match for a scan cache entry to be used.
+
+   Adding or removing audio files changes the folder modification time,
+   so this also catches audio files referenced by the Cue sheet appearing
+   or disappearing. The path is unicode so the key matches the one read
+   back from JSON.
+   """
+   st = os.stat(cue)
+   folder_st = os.stat(os.path.dirname(cue))
+   return [unicode_path(cue), int(st.st_mtime), st.st_size, int(folder_st.st_mtime)]
+
+
+def read_scan_cache(cue):
+   """Get the tracks stored for a Cue sheet by the last scan.
+
+   Returns None if there is no stored entry or anything has changed.
+   """
+   if(scan_cache_dir is None):
+      return None
+   try:
+      with open(scan_cache_file(cue), 'r') as f:
+         entry = json.load(f)
+      if(entry['key'] != scan_cache_key(cue)):
+         return None
+      # JSON gives back unicode. Use native strings as a fresh scan does,
+      # so the handled files match the files list.
+      tracks = [[native_path(value) if isinstance(value, type(u'')) else value
+                 for value in track] for track in entry['tracks']]
+      handled = [native_path(full_file) for full_file in entry['handled']]
+      return tracks, handled
+   except (IOError, OSError, ValueError, KeyError):
+      return None
+
+
+def write_scan_cache(cue, tracks, handled):
+   """Store the tracks for a Cue sheet for the next scan."""
+   if(scan_cache_dir is None):
+      return
+   try:
+      if(not os.path.isdir(scan_cache_dir)):
+         os.makedirs(scan_cache_dir)
+      filename = scan_cache_file(cue)
+      # Write to a temporary file first so an interrupted scan never
+      # leaves a partial entry.
+      temp = '{0}.{1}.tmp'.format(filename, os.getpid())
+      with open(temp, 'w') as f:
+         json.dump({'key': scan_cache_key(cue), 'tracks': tracks, 'handled': handled}, f)
+      os.rename(temp, filename)
+   except (IOError, OSError):
+      log(traceback.format_exc())
+
+
+def read_manifest(cue):
+   """Get the Cue sheet info from the manifest written by FLACCue.
+
+   Returns None if there is no manifest entry for the Cue sheet or the
+   Cue sheet or its folder has changed since the entry was written.
+   Adding or removing audio files changes the folder modification time.
+   """
+   if(manifest_dir is None):
+      return None
+   folder, name = os.path.split(cue)
+   filename = os.path.join(manifest_dir, folder.lstrip(os.sep), 'flaccue_manifest.json')
+   try:
+      with open(filename, 'r') as f:
+         # The manifest keys are unicode.
+         entry = json.load(f)['cues'][unicode_path(name)]
+      st = os.stat(cue)
+      folder_st = os.stat(folder)
+   except (IOError, OSError, ValueError, KeyError):
+      return None
+   if(entry['mtime'] != int(st.st_mtime) or entry['size'] != st.st_size or
+      entry.get('folder_mtime') != int(folder_st.st_mtime)):
+      log('Stale manifest entry for {0}'.format(cue))
+      return None
+   # Rebuild the structure returned by read_cue. The manifest already has
+   # the track artists filled in from the album artist where needed.
+   cue_info = {}
+   cue_info['Files'] = {}
+   # JSON strings are unicode. The scanner formats them into native
+   # strings, so convert them like the filenames.
+   cue_info['TITLE'] = native_text(entry['album'] or '')
+   cue_info['PERFORMER'] = native_text(entry['album_artist'] or '')
+   for filename, tracks in entry['files'].items():
+      track_details = {}
+      for track, title, artist, start, end in tracks:
+         track_details[track] = {'TITLE': native_text(title),
+                                 'PERFORMER': native_text(artist),
+                                 'INDEX': {1: start},
+                                 }
+      cue_info['Files'][AudioFiles.cleanPass(native_path(filename))] = {'Tracks': track_details}
+   return cue_info
+
+
+def read_cue(file):
+   """Parse the Cue sheet to get the desired info.
+   """
+   # Read the full Cue file.
+   with open(file, 'r') as f:
+      lines = f.readlines()
+   cue = {}
+   cue['Files'] = {}
+   # Line index. We don't use a for loop as we will
+   # read multiple lines for information.
+   i = 0
+   lenlines = len(lines)
+   try:
+      while(True):
+         # We have a FILE specification in the Cue sheet.
+         if(lines[i].startswith('FILE')):
+            # Get the filename.
+            filename = AudioFiles.cleanPass(lines[i].split('"')[1])
+            # Now we will parse the tracks from the file.
+            # Use a local variable name for clarity.
+            file_details = {}
+            # But store that variable in the cue sheet parse dictionary.
+            cue['Files'][filename] = file_details
+            # Create the Track entry to store tracks from the file.
+            file_details['Tracks'] = {}
+            # Start at the next line.
+            i += 1
+            # Use the Cue sheet indentation for sectioning. 2 spaces for
+            # TRACK entries in the FILE entry.
+            while(lines[i].startswith(' '*2)):
+               # Get rid of extra white space.
+               line = lines[i].strip()
+               # Handle TRACK entries.
+               if(line.startswith('TRACK')):
+                  # Get the track number.
+                  track = int(line.split()[1])
+                  # Use a local variable name for clarity.
+                  track_details = {}
+                  # But store that variable in the cue sheet parse dictionary.
+                  file_details['Tracks'][track] = track_details
+                  # Create the INDEX dictionary to store track indices.
+                  track_details['INDEX'] = {}
+                  # Start at the next line.
+                  i += 1
+                  # Use the Cue sheet indentation for sectioning. 4 spaces
+                  # for INDEX entries in the TRACK entry.
+                  while(lines[i].startswith(' '*4)):
+                     # Get rid of extra white space.
+                     line = lines[i].strip()
+                     # Find the index entries.
+                     if(line.startswith('INDEX')):
+                        # Remove the INDEX text and extra white space.
+                        line = line[5:].strip()
+                        # Get the INDEX number and the rest of the line.
+                        # The rest of the line should be the time information.
+                        key, value = line.split(None, 1)
+                        # Store the time information for this index.
+                        track_details['INDEX'][int(key)] = value.strip().replace('"', '')
+                        i += 1
+                     else:
+                        # Store all the other entries as text. Use the first
+                        # word as the access key.
+                        key, value = line.split(None, 1)
+                        # Also remove quotes from track names and similar.
+                        track_details[key] = value.strip().replace('"', '')
+                        i += 1
+               else:
+                  # Store all the other entries as text. Use the first
+                  # word as the access key.
+                  key, value = lines[i].split(None, 1)
+                  # Also remove quotes from track names and similar.
+                  file_details[key] = value.strip().replace('"', '')
+                  i += 1
+         else:
+            # Store all the other entries as text. Use the first
+            # word as the access key.
+            key, value = lines[i].split(None, 1)
+            # Also remove quotes from track names and similar.
+            cue[key] = value.strip().replace('"', '')
+            i += 1
+   except IndexError:
+      # We're done.
+      pass
+   return cue
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""Benchmark cue sheet parsing.
+
+Generates a corpus of cue sheets in a temporary directory (various
+encodings with and without byte order marks or non-ASCII FILE names,
+large multi-FILE sheets,
+oddly formatted sheets, and broken sheets) and
+reports parses per second and peak memory for read_cue and
+FLACCue.get_cue_files. Nothing is downloaded and no FUSE mount is made.
+
+Run from the repository root:
+python benchmarks/bench_cue.py -o bench_output.txt
+"""
+
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Import flaccue.py from the repository root and the vendored fuse.py
+# from the Synology package.
+repository = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(repository, 'synology_package', 'FLACCue'))
+sys.path.insert(0, repository)
+
+import flaccue
+
+
+# Album title, performer, and track titles used for each language.
+languages = {
+    'english': ('Greatest Hits', 'The Band',
+                ['Opening', 'Second Song', 'Another One', 'Finale']),
+    'western': ('Été à Paris', 'Chloé Dupré',
+                ['Déjà vu', 'Garçon', 'Über alles', 'Señorita']),
+    'japanese': ('東京の夜', '山田太郎',
+                 ['はじまり', '夜明けの歌', 'さくら', 'おわり']),
+    'chinese': ('北京之春', '王小明',
+                ['开始', '月亮代表我的心', '茉莉花', '结束']),
+    'korean': ('서울의 밤', '김민수',
+               ['시작', '아리랑', '봄날', '끝']),
+    'russian': ('Времена года', 'Пётр Чайковский',
+                ['Январь', 'Февраль', 'Март', 'Апрель']),
+    }
+
+# (case name, language, encoding). Encodings ending in _sig or utf_16
+# and utf_32 write a byte order mark. Those ending in _le or _be do not.
+encoded_cases = [
+    ('ascii', 'english', 'ascii'),
+    ('utf-8', 'japanese', 'utf_8'),
+    ('utf-8 bom', 'chinese', 'utf_8_sig'),
+    ('utf-16 bom', 'russian', 'utf_16'),
+    ('utf-32 bom', 'korean', 'utf_32'),
+    ('utf-16le', 'western', 'utf_16_le'),
+    ('utf-16be', 'japanese', 'utf_16_be'),
+    ('utf-32le', 'russian', 'utf_32_le'),
+    ('utf-32be', 'chinese', 'utf_32_be'),
+    ('cp1252', 'western', 'cp1252'),
+    ('cp1251', 'russian', 'cp1251'),
+    ('shift-jis', 'japanese', 'shift_jis'),
+    ('gbk', 'chinese', 'gbk'),
+    ('euc-kr', 'korean', 'euc_kr'),
+    ]
+
+# (case name, language, encoding) for sheets whose FILE name is plain
+# ASCII, as many rippers write them. The FILE name can't tell the
+# encodings apart, so these are detected from the text alone.
+ascii_file_cases = [
+    ('cp1252 ascii file', 'western', 'cp1252'),
+    ('latin-1 ascii file', 'western', 'latin_1'),
+    ('cp1251 ascii file', 'russian', 'cp1251'),
+    ('gbk ascii file', 'chinese', 'gbk'),
+    ('shift-jis ascii file', 'japanese', 'shift_jis'),
+    ]
+
+
+def cue_time(frames):
+    """Format frames as a MM:SS:FF Cue sheet time."""
+    seconds, frames = divmod(frames, 75)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{minutes:02d}:{seconds:02d}:{frames:02d}'
+
+
+def make_cue(album, performer, files, indent=('  ', '    '), newline='\n',
+             quote_files=True, numbers=None):
+    """Build the text of a Cue sheet.
+
+    Parameters
+    ----------
+    album : str
+        The album title.
+    performer : str
+        The album performer.
+    files : list of (str, list of str)
+        The FILE names and the track titles in each file.
+    indent : tuple of str (optional)
+        The indentation used for TRACK and INDEX level lines.
+    newline : str (optional)
+        The line ending to use.
+    quote_files : bool (optional)
+        If False, write FILE names without quotes.
+    numbers : list of int (optional)
+        The TRACK numbers to write, in order. Defaults to numbering
+        the tracks from 1.
+    """
+    lines = ['REM GENRE "Benchmark"',
+             'REM DATE 2000',
+             f'PERFORMER "{performer}"',
+             f'TITLE "{album}"',
+             ]
+    track = 1
+    for name, titles in files:
+        if(quote_files):
+            lines.append(f'FILE "{name}" WAVE')
+        else:
+            lines.append(f'FILE {name} WAVE')
+        frames = 0
+        for title in titles:
+            number = numbers[track - 1] if numbers is not None else track
+            lines.append(f'{indent[0]}TRACK {number:02d} AUDIO')
+            lines.append(f'{indent[1]}TITLE "{title}"')
+            lines.append(f'{indent[1]}PERFORMER "{performer}"')
+            if(frames > 0):
+                lines.append(f'{indent[1]}INDEX 00 {cue_time(frames - 150)}')
+            lines.append(f'{indent[1]}INDEX 01 {cue_time(frames)}')
+            frames += 75*(180 + 7*track)
+            track += 1
+    return newline.join(lines) + newline
+
+
+def generate_corpus(directory):
+    """Write the benchmark cue sheets and their referenced audio files.
+
+    Returns
+    -------
+    cases : list of (str, str, str)
+        The case name, cue filename, and the expected decoded text.
+    """
+    cases = []
+
+    def write(case, text, encoding, files):
+        folder = os.path.join(directory, case.replace(' ', '_'))
+        os.makedirs(folder, exist_ok=True)
+        # Empty stand-ins for the audio files so get_cue_files keeps them.
+        for name, titles in files:
+            open(os.path.join(folder, name), 'wb').close()
+        cue_file = os.path.join(folder, 'album.cue')
+        with open(cue_file, 'wb') as f:
+            f.write(text.encode(encoding))
+        cases.append((case, cue_file, text))
+
+    for case, language, encoding in encoded_cases:
+        album, performer, titles = languages[language]
+        files = [(f'{performer} - {album}.flac', titles)]
+        if(encoding == 'ascii'):
+            # Keep the filename plain for the ascii case.
+            files = [('The Band - Greatest Hits.flac', titles)]
+        write(case, make_cue(album, performer, files), encoding, files)
+
+    for case, language, encoding in ascii_file_cases:
+        album, performer, titles = languages[language]
+        files = [('CDImage.flac', titles)]
+        write(case, make_cue(album, performer, files), encoding, files)
+
+    # The largest possible disc: 99 tracks across several FILE entries.
+    titles = [f'Movement {track}' for track in range(1, 100)]
+    files = [(f'Huge Box Set Disc {disc + 1}.flac', titles[disc*33:(disc + 1)*33])
+             for disc in range(3)]
+    write('99 tracks multi-file', make_cue('Huge Box Set', 'Orchestra', files),
+          'utf_8', files)
+
+    # Formatting variations seen in the wild.
+    album, performer, titles = languages['english']
+    files = [('Odd Layout.flac', titles)]
+    write('tab indented', make_cue(album, performer, files, indent=('\t', '\t\t')),
+          'utf_8', files)
+    write('unindented', make_cue(album, performer, files, indent=('', '')),
+          'utf_8', files)
+    write('crlf', make_cue(album, performer, files, newline='\r\n'), 'utf_8', files)
+    files = [('Unquoted.flac', titles)]
+    write('unquoted file', make_cue(album, performer, files, quote_files=False),
+          'utf_8', files)
+    files = [('Long Titles.flac', ['A very long title ' * 40 + str(i) for i in range(99)])]
+    write('long titles', make_cue(album, performer, files), 'utf_8', files)
+
+    # Broken sheets. The parser should keep what it can. Errors are
+    # reported for the case.
+    files = [('Missing Index.flac', titles)]
+    text = make_cue(album, performer, files)
+    # Drop the INDEX 01 line of the second track.
+    text = text.replace(f'    INDEX 01 {cue_time(75*187)}\n', '')
+    write('missing index 01', text, 'utf_8', files)
+    files = [('No Tracks.flac', []), ('Has Tracks.flac', titles)]
+    write('file without tracks', make_cue(album, performer, files), 'utf_8', files)
+    files = [('Out Of Order.flac', titles)]
+    write('out of order tracks', make_cue(album, performer, files, numbers=[3, 1, 4, 2]),
+          'utf_8', files)
+    files = [('Junk Lines.flac', titles)]
+    lines = make_cue(album, performer, files).splitlines()
+    # Unknown keywords, keywords without values, a line of garbage
+    # bytes, and a truncated final line without a newline.
+    lines[5:5] = ['CATALOG', 'TRACK', 'INDEX', 'FLAGS DCP', '\x7f\x01 ~~ junk ~~']
+    lines.insert(-2, '    INDEX 01')
+    text = '\n'.join(lines) + '\n  TRACK 05 AUD'
+    write('junk and truncated', text, 'utf_8', files)
+    return cases
+
+
+def measure(function, iterations):
+    """Time function over the iterations and measure its peak memory.
+
+    Returns
+    -------
+    rate : float
+        Calls per second.
+    peak : int
+        Peak traced memory in bytes for a single call.
+    """
+    function()
+    start = time.perf_counter()
+    for i in range(iterations):
+        function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return iterations/elapsed, peak
+
+
+def run(iterations=200, output=None):
+    """Generate the corpus, run the benchmarks, and print the results.
+
+    Parameters
+    ----------
+    iterations : int (optional)
+        The number of parses timed for each case.
+    output : file or None (optional)
+        A file to also write the results to.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        cases = generate_corpus(directory)
+        filesystem = flaccue.FLACCue(directory, directory, cache_cue=False)
+        header = (f'{"case":<22}{"read_cue/s":>12}{"peak KiB":>10}'
+                  f'{"get_cue_files/s":>17}{"peak KiB":>10}{"tracks":>8}  decoded')
+        lines = [header, '-'*len(header)]
+        for case, cue_file, text in cases:
+            try:
+                read_rate, read_peak = measure(lambda: flaccue.read_cue(cue_file), iterations)
+                files_rate, files_peak = measure(lambda: filesystem.get_cue_files(cue_file),
+                                                 iterations)
+                to_add, meta, to_remove = filesystem.get_cue_files(cue_file)
+            except Exception as e:
+                lines.append(f'{case:<22}  ERROR {type(e).__name__}: {e}')
+                continue
+            # Check whether the encoding detection recovered the original
+            # text, checking the FILE names against the folder as read_cue does.
+            with open(cue_file, 'rb') as f:
+                decoded = flaccue.decode_cue(f.read(), directory=os.path.dirname(cue_file))
+            correct = 'ok' if decoded == text else 'MISMATCH'
+            lines.append(f'{case:<22}{read_rate:>12.0f}{read_peak/1024:>10.1f}'
+                         f'{files_rate:>17.0f}{files_peak/1024:>10.1f}{len(to_add):>8}  {correct}')
+    for line in lines:
+        print(line)
+        if(output is not None):
+            print(line, file=output)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark cue sheet parsing.')
+    parser.add_argument('-n', '--iterations',
+                        dest='iterations', type=int,
+                        default=200,
+                        help='The number of parses timed for each case.')
+    parser.add_argument('-o', '--output',
+                        dest='output', type=str,
+                        default=None,
+                        help='A file to also write the results to.')
+    args = parser.parse_args()
+    if(args.output is not None):
+        with open(args.output, 'w') as output:
+            run(args.iterations, output)
+    else:
+        run(args.iterations)
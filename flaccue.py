@@ -7,12 +7,31 @@ give anyone read access to any file by just prepending /flaccue/.
 """
 
 
+import array
+import codecs
+import collections
+import collections.abc
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
+import pickle
+import re
+import signal
+import sqlite3
+import struct
 import tempfile
+import unicodedata
 
 import ffmpeg
 import mutagen
-import numpy
 import time
 import threading
 
@@ -31,11 +50,7 @@ encodings_to_test = [
     'latin_1',
     'big5',
     'big5hkscs',
-    'cp037',
-    'cp273',
-    'cp424',
     'cp437',
-    'cp500',
     'cp720',
     'cp737',
     'cp775',
@@ -54,14 +69,11 @@ encodings_to_test = [
     'cp866',
     'cp869',
     'cp874',
-    'cp875',
     'cp932',
     'cp949',
     'cp950',
     'cp1006',
-    'cp1026',
     'cp1125',
-    'cp1140',
     'cp1250',
     'cp1251',
     'cp1252',
@@ -125,108 +137,2217 @@ encodings_to_test = [
     ]
 
 
-def read_cue(file, verbose=False):
+# Byte order marks identify the encoding without any guessing. The
+# UTF-32 marks must be checked before the UTF-16 marks as they share
+# a prefix.
+byte_order_marks = [
+    (codecs.BOM_UTF8, 'utf_8_sig'),
+    (codecs.BOM_UTF32_LE, 'utf_32'),
+    (codecs.BOM_UTF32_BE, 'utf_32'),
+    (codecs.BOM_UTF16_LE, 'utf_16'),
+    (codecs.BOM_UTF16_BE, 'utf_16'),
+    ]
+
+# These reject nearly all text written in other encodings, so they are
+# always tried first. Otherwise a permissive encoding such as latin_1
+# could learn its way ahead of them and claim valid UTF-8 files.
+strict_encodings = ['ascii', 'utf_8']
+
+# Without a byte order mark, these decode most single byte text without
+# error. Text in these encodings always contains NUL bytes, so they are
+# only tried when NUL bytes are present.
+wide_encodings = ['utf_16', 'utf_32', 'utf_16_be', 'utf_16_le', 'utf_32_be', 'utf_32_le']
+
+# Single byte encodings for the common Western, Central European,
+# Greek, and Cyrillic text. These are tried first since any byte string
+# decodes in most single byte encodings.
+preferred_encodings = [
+    'cp1252',
+    'cp1250',
+    'cp1251',
+    'cp1253',
+    'cp1254',
+    'cp1255',
+    'cp1256',
+    'cp1257',
+    'cp1258',
+    'iso8859_15',
+    'iso8859_2',
+    'koi8_r',
+    'koi8_u',
+    ]
+
+# These decode a lot of single byte text without error (into unusual
+# characters), so they are tried after the preferred single byte
+# encodings and only used when their text is more plausible. Encodings
+# that reject the most text in the others come first, since ties go to
+# the earlier encoding. The other
+# single byte encodings, such as the DOS and Mac code pages, are tried
+# last since they decode multibyte text into plausible looking letters.
+multibyte_encodings = [
+    'shift_jis',
+    'cp932',
+    'shift_jis_2004',
+    'shift_jisx0213',
+    'gbk',
+    'gb2312',
+    'gb18030',
+    'big5',
+    'cp950',
+    'big5hkscs',
+    'euc_kr',
+    'cp949',
+    'johab',
+    'euc_jp',
+    'euc_jis_2004',
+    'euc_jisx0213',
+    'hz',
+    'iso2022_jp',
+    'iso2022_jp_1',
+    'iso2022_jp_2',
+    'iso2022_jp_2004',
+    'iso2022_jp_3',
+    'iso2022_jp_ext',
+    'iso2022_kr',
+    'utf_7',
+    ]
+
+# This decodes every byte string, so it is only used when nothing
+# else works.
+last_resort_encodings = ['latin_1']
+
+# The number of cue files each encoding has successfully decoded. Within
+# each group, encodings are tried in order of success so the encodings
+# common in the library are found first.
+_encoding_successes = collections.Counter()
+
+
+def _ranked_encodings(wide):
+    """Get the groups of encodings to try for a Cue sheet without a byte order mark.
+
+    If wide is True, the wide encodings come first, since the strict
+    encodings decode most wide text with NULs between the characters.
+    Then come the strict encodings, the preferred single byte
+    encodings, the multibyte encodings, the other single byte
+    encodings, and finally the last resort. The encodings within each
+    group are ranked by success, keeping the order of their lists for
+    equal success.
+    """
+    others = [encoding for encoding in encodings_to_test
+              if encoding not in strict_encodings + wide_encodings + preferred_encodings +
+              multibyte_encodings + last_resort_encodings]
+    groups = ([wide_encodings] if wide else []) + [
+        [encoding] for encoding in strict_encodings] + [
+        preferred_encodings, multibyte_encodings, others, last_resort_encodings]
+    groups = [[encoding for encoding in group if encoding in encodings_to_test]
+              for group in groups]
+    return [sorted(group, key=lambda encoding: -_encoding_successes[encoding])
+            for group in groups if group]
+
+
+# Punctuation found in ordinary text outside of ASCII. Other symbols,
+# such as box drawing characters, usually mean the wrong encoding.
+plausible_punctuation = set('\u00a0\u00a1\u00bf\u00ab\u00bb\u00b7\u2018\u2019\u201c\u201d'
+                            '\u201e\u2013\u2014\u2026\u2022\u00b0\u00a9\u00ae\u2122\u00d7'
+                            '\u3000\u3001\u3002\u300c\u300d\u30fb\uff08\uff09')
+
+# Scripts that are written together within a word.
+_script_families = {'HIRAGANA': 'CJK', 'KATAKANA': 'CJK', 'KATAKANA-HIRAGANA': 'CJK',
+                    'IDEOGRAPHIC': 'CJK', 'FULLWIDTH': 'CJK'}
+
+# The byte ranges of the common ideographs in some multibyte encodings
+# (GB2312 level 1, Big5 level 1, and JIS level 1).
+common_ideographs = [
+    ('gb2312', b'\xb0\xa1', b'\xd7\xfe'),
+    ('big5', b'\xa4\x40', b'\xc6\x7e'),
+    ('shift_jis', b'\x88\x9f', b'\x98\x72'),
+    ]
+
+_scripts = {}
+
+
+def _common_ideograph(character):
+    """Check whether a CJK ideograph is one of the commonly used ones."""
+    for encoding, first, last in common_ideographs:
+        try:
+            if(first <= character.encode(encoding) <= last):
+                return True
+        except UnicodeError:
+            pass
+    return False
+
+
+def _script(character):
+    """Get the script of a character from its Unicode name (e.g. LATIN).
+
+    Returns None for letters that are unlikely in text, such as
+    presentation forms and rare ideographs.
+    """
+    try:
+        return _scripts[character]
+    except KeyError:
+        pass
+    name = unicodedata.name(character, '?')
+    if(unicodedata.decomposition(character).startswith('<')):
+        # Compatibility characters such as presentation forms.
+        script = None
+    elif(name.startswith('CJK UNIFIED IDEOGRAPH') and not _common_ideograph(character)):
+        script = None
+    else:
+        script = name.split(' ')[0]
+        script = _script_families.get(script, script)
+    _scripts[character] = script
+    return script
+
+
+# Vowels (without accents) of the alphabetic scripts. Words with a mix
+# of upper and lower case letters in these scripts are expected to have
+# a vowel.
+vowels = {
+    'LATIN': set('aeiouyAEIOUY'),
+    'CYRILLIC': set('аеиоуыэюяіїєАЕИОУЫЭЮЯІЇЄ'),
+    'GREEK': set('αεηιουωΑΕΗΙΟΥΩ'),
+    }
+
+_token_pattern = re.compile(r'\w+|[^\w\s]')
+_is_ascii = re.compile(r'[\x00-\x7f]*\Z').match
+_control_pattern = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+
+def text_score(text):
+    """Score how plausible the non-ASCII characters of decoded text are.
+
+    Text decoded with the wrong encoding mixes scripts within words
+    (CafΘ), writes whole words in accented Latin letters (Ïðèâåò for
+    Привет), switches from lower to upper case within words (рТЙЧЕФ
+    for Привет), has no vowels (Нх), or uses unusual symbols,
+    presentation forms, or rare ideographs. Each non-ASCII character counts as plausible if it is
+    common punctuation or is in a word of a single script without those
+    problems.
+
+    Returns
+    -------
+    score : float
+        The fraction of non-ASCII and control characters that are
+        plausible, or 1 for ASCII text.
+    """
+    total = 0
+    plausible = 0
+    for line in text.splitlines():
+        # Control characters (such as the NULs from decoding UTF-32 as
+        # UTF-16) are never plausible.
+        total += len(_control_pattern.findall(line))
+        if(_is_ascii(line)):
+            continue
+        for token in _token_pattern.findall(line):
+            if(_is_ascii(token)):
+                continue
+            count = sum(1 for character in token if character >= '\x80')
+            total += count
+            if(len(token) == 1 and not token.isalnum()):
+                plausible += count if token in plausible_punctuation else 0
+                continue
+            letters = [character for character in token if character.isalpha()]
+            scripts = set('LATIN' if character < '\x80' else _script(character)
+                          for character in letters)
+            if(len(scripts) > 1 or None in scripts):
+                continue
+            if(scripts == {'LATIN'} and len(letters) > 1 and
+               not any(character < '\x80' for character in letters)):
+                continue
+            if(any(first.islower() and second.isupper()
+                   for first, second in zip(letters, letters[1:]))):
+                continue
+            script, = scripts or [None]
+            if(script in vowels and len(letters) > 1 and not token.isupper() and
+               vowels[script].isdisjoint(unicodedata.normalize('NFD', token))):
+                continue
+            plausible += count
+    return plausible/total if total else 1.0
+
+
+def _cue_file_name(value):
+    """Get the filename from the text following a FILE keyword."""
+    if('"' in value):
+        return value.split('"')[1]
+    # Unquoted filename followed by the file type.
+    return value.rsplit(None, 1)[0]
+
+
+def _files_exist(text, directory, exists):
+    """Check whether the non-ASCII FILE names of decoded Cue sheet text exist.
+
+    Names that are plain ASCII decode the same in every candidate
+    encoding, so they don't tell the encodings apart and are not
+    checked.
+    """
+    for line in text.splitlines():
+        parts = line.split(None, 1)
+        if(len(parts) < 2 or parts[0] != 'FILE' or _is_ascii(parts[1])):
+            continue
+        try:
+            name = _cue_file_name(parts[1])
+        except IndexError:
+            continue
+        if(not exists(os.path.join(directory, name))):
+            return False
+    return True
+
+
+def decode_cue(data, verbose=False, directory=None, exists=os.path.exists):
+    """Decode the raw bytes of a Cue sheet.
+
+    Without a byte order mark, ASCII and UTF-8 are used if they decode
+    the data (after trying the wide encodings on data with NULs).
+    Otherwise each candidate encoding is scored by text_score
+    and the most plausible text is used, taking the earlier encoding on
+    ties. The search stops at the end of the first group of encodings
+    with a fully plausible result.
+
+    Parameters
+    ----------
+    data : bytes
+        The full contents of the Cue sheet.
+    verbose : bool (optional)
+        If True, print out the encoding used.
+    directory : str (optional)
+        The directory containing the Cue sheet. If given, ties are
+        broken in favor of encodings whose non-ASCII FILE names exist
+        in the directory.
+    exists : callable (optional)
+        The function used to check whether a file exists.
+
+    Returns
+    -------
+    text : str
+        The decoded Cue sheet.
+    """
+    for bom, encoding in byte_order_marks:
+        if(data.startswith(bom)):
+            groups = [[encoding]]
+            # Don't count these toward the ranking. Without a byte
+            # order mark, utf_16 will decode most single byte text.
+            learn = False
+            break
+    else:
+        learn = True
+        groups = _ranked_encodings(b'\0' in data)
+    # (score, whether the FILE names exist, encoding, text)
+    best = None
+    for group in groups:
+        for encoding in group:
+            try:
+                text = data.decode(encoding)
+            except UnicodeError:
+                continue
+            score = text_score(text)
+            if(best is not None and score < best[0]):
+                continue
+            found = directory is None or _files_exist(text, directory, exists)
+            if(best is None or (score, found) > best[:2]):
+                best = (score, found, encoding, text)
+            if(best[:2] == (1.0, True)):
+                break
+        if(best is not None and (best[0] == 1.0 or group[0] in strict_encodings)):
+            # The text is fully plausible, or was decoded as ASCII or UTF-8.
+            break
+    if(best is None):
+        raise UnicodeError('Unable to find appropriate encoding for input file.')
+    encoding, text = best[2:]
+    if(learn):
+        _encoding_successes[encoding] += 1
+    if(verbose):
+        print(f'Parsed using "{encoding}" encoding.', flush=True)
+    return text
+
+
+# Cue sheet times are given as MM:SS:FF with 75 frames per second.
+FRAMES_PER_SECOND = 75
+
+
+def cue_time_to_frames(value):
+    """Convert a MM:SS:FF Cue sheet time into frames.
+
+    Returns -1 for anything that is not a valid time. This is used
+    to mark the end of the file.
+    """
+    try:
+        minutes, seconds, frames = (int(x) for x in value.split(':'))
+    except ValueError:
+        return -1
+    return (minutes*60 + seconds)*FRAMES_PER_SECOND + frames
+
+
+def frames_to_cue_time(frames):
+    """Convert frames into a MM:SS:FF Cue sheet time."""
+    if(frames < 0):
+        return '-1'
+    seconds, frames = divmod(frames, FRAMES_PER_SECOND)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{minutes:02d}:{seconds:02d}:{frames:02d}'
+
+
+class CueFile(object):
+    """A FILE entry from a Cue sheet.
+
+    The tracks are stored column-wise to keep large libraries compact.
+    Track starts are the INDEX 01 times in frames, or -1 if the
+    track did not list one. Missing titles and performers are None.
+    """
+
+    __slots__ = ('name', 'numbers', 'titles', 'performers', 'starts')
+
+    def __init__(self, name):
+        self.name = name
+        self.numbers = array.array('H')
+        self.titles = []
+        self.performers = []
+        self.starts = array.array('l')
+
+    def __len__(self):
+        return len(self.numbers)
+
+
+class CueSheet(object):
+    """The album level details of a Cue sheet and its FILE entries."""
+
+    __slots__ = ('title', 'performer', 'files')
+
+    def __init__(self):
+        self.title = None
+        self.performer = None
+        self.files = []
+
+
+def _cue_value(value):
+    """Clean up the text following a Cue sheet keyword."""
+    # Also remove quotes from track names and similar.
+    return sys.intern(value.strip().replace('"', ''))
+
+
+def parse_cue(lines):
+    """Parse the lines of a Cue sheet into a CueSheet.
+
+    Entries are assigned by keyword rather than indentation, so tab
+    indented and unindented Cue sheets parse the same as the usual
+    two and four space layout. TRACK and INDEX lines without valid
+    numbers are skipped.
+    """
+    cue = CueSheet()
+    current_file = None
+    # Whether TITLE and PERFORMER entries belong to a track.
+    in_track = False
+    for line in lines:
+        parts = line.split(None, 1)
+        if(not parts):
+            continue
+        keyword = parts[0]
+        value = parts[1] if len(parts) > 1 else ''
+        if(keyword == 'FILE'):
+            name = _cue_file_name(value)
+            current_file = CueFile(sys.intern(name))
+            cue.files.append(current_file)
+            in_track = False
+        elif(keyword == 'TRACK'):
+            if(current_file is None):
+                continue
+            try:
+                number = int(value.split()[0])
+            except (IndexError, ValueError):
+                continue
+            current_file.numbers.append(number)
+            current_file.titles.append(None)
+            current_file.performers.append(None)
+            current_file.starts.append(-1)
+            in_track = True
+        elif(keyword == 'INDEX'):
+            if(not in_track):
+                continue
+            # Get the INDEX number and the rest of the line.
+            # The rest of the line should be the time information.
+            try:
+                key, time = value.split(None, 1)
+                key = int(key)
+            except ValueError:
+                continue
+            if(key == 1):
+                current_file.starts[-1] = cue_time_to_frames(_cue_value(time))
+        elif(keyword in ('TITLE', 'PERFORMER')):
+            value = _cue_value(value)
+            if(in_track):
+                if(keyword == 'TITLE'):
+                    current_file.titles[-1] = value
+                else:
+                    current_file.performers[-1] = value
+            elif(current_file is None):
+                if(keyword == 'TITLE'):
+                    cue.title = value
+                else:
+                    cue.performer = value
+    return cue
+
+
+def read_cue(file, verbose=False, exists=os.path.exists):
     """Parse the Cue sheet to get the desired info."""
     # Read the full Cue file.
     if(verbose):
         print(f'Parsing {file}...', flush=True)
-    lines = None
-    for encoding in encodings_to_test:
+    with open(file, 'rb') as f:
+        data = f.read()
+    text = decode_cue(data, verbose=verbose, directory=os.path.dirname(file),
+                      exists=exists)
+    return parse_cue(text.splitlines())
+
+
+class TrackMeta(collections.abc.Mapping):
+    """Metadata for a track generated from the cue sheet.
+
+    This acts as the dictionary of output options passed to ffmpeg
+    while only storing references to the (interned) values. The album
+    artist is kept for the manifests but not passed to ffmpeg.
+    """
+
+    __slots__ = ('artist', 'album', 'disc', 'track', 'title', 'album_artist')
+
+    # A bit of a hack needed for ffmpeg interfacing.
+    _options = {'metadata:g:1': 'artist',
+                'metadata:g:2': 'album',
+                'metadata:g:3': 'disc',
+                'metadata:g:4': 'track',
+                'metadata:g:5': 'title',
+                }
+
+    def __init__(self, artist, album, disc, track, title, album_artist=None):
+        self.artist = artist
+        self.album = album
+        self.disc = disc
+        self.track = track
+        self.title = title
+        self.album_artist = album_artist
+
+    def __getitem__(self, key):
+        name = self._options[key]
+        return f'{name}={getattr(self, name)}'
+
+    def __iter__(self):
+        return iter(self._options)
+
+    def __len__(self):
+        return len(self._options)
+
+
+def cue_tracks(cue_file, format, verbose=False, exists=os.path.exists):
+    """Get the tracks and referenced files for a cue file.
+
+    Parameters
+    ----------
+    cue_file : str
+        The cue filename.
+    format : str
+        The output format for the extracted tracks.
+    verbose : bool (optional)
+        If True, print out extra information on the parsed
+        cue file.
+    exists : callable (optional)
+        The function used to check whether the referenced files exist
+        when detecting the encoding.
+
+    Returns
+    -------
+    to_add, meta, to_remove
+        See FLACCue.get_cue_files. Files are included whether or not
+        they exist, so the results only depend on the cue file. Use
+        present_tracks to drop missing files.
+    """
+    unknown_tracks = 0
+    cue = read_cue(cue_file, verbose=verbose, exists=exists)
+    to_remove = []
+    to_add = {}
+    meta = {}
+    # Get the album information.
+    album = cue.title if cue.title is not None else 'Unknown'
+    album_artist = cue.performer if cue.performer is not None else ''
+    if(album_artist == ''):
+        # No listed album artist. Use the artist from the first
+        # track of the first file.
         try:
-            with open(file, 'r', encoding=encoding) as f:
-                lines = f.readlines()
-            if(verbose):
-                print(f'Parsed using "{encoding}" encoding.', flush=True)
-            break
-        except UnicodeError:
+            album_artist = cue.files[0].performers[0]
+        except IndexError:
+            album_artist = None
+        if(album_artist is None):
+            album_artist = 'Unknown'
+    for cuefile in cue.files:
+        file = cuefile.name
+        # Get the full file path.
+        full_file = os.path.join(os.path.dirname(cue_file), file)
+
+        # My cue files include "Disc 1", "Disc 2", and similar as the
+        # final part of the title for multi-disk sets. Something like:
+        # "Artist - Album Title Disc 3.cue"
+        # The scanner is designed to pull disc information from this
+        # and to group albums together.
+
+        # Get the name of the cue file without the extension.
+        # Split it for white space.
+        try:
+            file_details = os.path.splitext(file)[-2].split()
+            # Check for disc numbering.
+            if(file_details[-2] == 'Disc'):
+                disc = int(file_details[-1])
+            else:
+                disc = 1
+        except IndexError:
+            disc = ''
+
+        # Split into tracks.
+        end = 0
+        # Handle each track.
+        for i, track in enumerate(cuefile.numbers):
+            title = cuefile.titles[i]
+            if(title is None):
+                unknown_tracks += 1
+                title = f'Unknown {unknown_tracks}'
+            artist = cuefile.performers[i]
+            if(artist is None):
+                # No track artist specified. Use the album artist.
+                artist = album_artist
+            # Get the start time of the track. If none is listed,
+            # use the previous end time.
+            start = cuefile.starts[i] if cuefile.starts[i] >= 0 else end
+            # Use the start time of the following track as the end
+            # time for the current track. For the last track, -1
+            # indicates the end of file.
+            try:
+                end = cuefile.starts[i+1]
+            except IndexError:
+                end = -1
+            start_time = frames_to_cue_time(start)
+            end_time = frames_to_cue_time(end)
+            track_file = f'{artist} - {album} - {disc}{track:02d} {title}.{format}'
+            track_file = track_file.replace('/', ' ')
+            to_add[track_file] = full_file + f'.flaccuesplit.{start_time}.{end_time}.{format}'
+            meta[track_file] = TrackMeta(artist, album, disc, track, title, album_artist)
+        # Remove the FLAC file from the list to parse.
+        to_remove.append(file)
+    return to_add, meta, to_remove
+
+
+def present_tracks(cue_file, parsed, exists=os.path.exists):
+    """Drop the tracks and files of a parsed cue file whose audio file is missing.
+
+    Parameters
+    ----------
+    cue_file : str
+        The cue filename.
+    parsed : tuple
+        The (to_add, meta, to_remove) results from cue_tracks.
+    exists : callable (optional)
+        The function used to check whether a file exists.
+
+    Returns
+    -------
+    to_add, meta, to_remove
+        The results for the audio files that currently exist.
+    """
+    to_add, meta, to_remove = parsed
+    directory = os.path.dirname(cue_file)
+    present = [file for file in to_remove if exists(os.path.join(directory, file))]
+    if(len(present) == len(to_remove)):
+        return parsed
+    sources = set(os.path.join(directory, file) for file in present)
+    to_add = dict((track_file, split) for track_file, split in to_add.items()
+                  if split.split('.flaccuesplit.')[0] in sources)
+    meta = dict((track_file, meta[track_file]) for track_file in to_add)
+    return to_add, meta, present
+
+
+# The name of the manifest file written for each directory.
+MANIFEST_NAME = 'flaccue_manifest.json'
+
+
+def manifest_path(manifest_dir, directory):
+    """Get the manifest filename for a directory on the mirrored filesystem.
+
+    The manifest directory mirrors the full directory structure so the
+    Plex scanner can find the manifest from the real directory path.
+    """
+    return os.path.join(manifest_dir, directory.lstrip(os.sep), MANIFEST_NAME)
+
+
+def manifest_entry(st, parsed, folder_st):
+    """Build the manifest entry for a parsed cue file.
+
+    Parameters
+    ----------
+    st : os.stat_result
+        The stat details for the cue file when it was parsed.
+    parsed : tuple
+        The (to_add, meta, to_remove) results from get_cue_files.
+    folder_st : os.stat_result
+        The stat details for the directory of the cue file from before
+        the audio files were checked. Adding or removing audio files
+        changes its modification time.
+
+    Returns
+    -------
+    entry : dict
+        JSON compatible details of the resolved tracks. The tracks for
+        each audio file are listed as [track, title, artist, start, end]
+        with start and end as Cue sheet times ('-1' for end of file).
+    """
+    to_add, meta, to_remove = parsed
+    entry = {'mtime': int(st.st_mtime),
+             'size': st.st_size,
+             'folder_mtime': int(folder_st.st_mtime),
+             'album': None,
+             'album_artist': None,
+             'files': {},
+             }
+    for track_file, split in to_add.items():
+        track_meta = meta[track_file]
+        source, details = split.split('.flaccuesplit.')
+        start, end = os.path.splitext(details)[0].split('.')
+        entry['album'] = track_meta.album
+        entry['album_artist'] = track_meta.album_artist
+        tracks = entry['files'].setdefault(os.path.basename(source), [])
+        tracks.append([track_meta.track, track_meta.title, track_meta.artist, start, end])
+    for tracks in entry['files'].values():
+        tracks.sort()
+    return entry
+
+
+def file_signature(path, stat=os.stat):
+    """Get the modification time and size used to validate cached entries.
+
+    Returns None if the path can not be accessed. stat may be replaced
+    with a cached equivalent such as BackingStore.stat.
+    """
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def track_inode(st, times, name):
+    """Get a stable inode number for a track split from an audio file.
+
+    The number is derived from the device and inode of the base file,
+    the track times, and the track filename (different cue sheets for
+    one file give different tracks), so it stays the same across
+    restarts and while the file is unchanged or only touched. The high bit is set to
+    keep it clear of the real inode numbers passed through for other
+    files.
+
+    Parameters
+    ----------
+    st : os.stat_result
+        The stat result for the base audio file.
+    times : str
+        The "{start_time}.{end_time}" portion of the split path.
+    name : str
+        The track filename.
+    """
+    key = f'{st.st_dev}:{st.st_ino}:{times}:{name}'
+    digest = hashlib.blake2b(key.encode('utf_8', errors='surrogateescape'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') | (1 << 63)
+
+
+def file_inode(st, root_dev):
+    """Get the inode number for a file passed through unchanged.
+
+    Files on the same device as the root keep their own inode number.
+    Inode numbers are only unique within a device, so files on other
+    devices (below mount points in the root) get a number derived from
+    their device and inode instead, with the high bit set like
+    track_inode.
+
+    Parameters
+    ----------
+    st : os.stat_result
+        The stat result for the file.
+    root_dev : int
+        The device of the root directory.
+    """
+    if(st.st_dev == root_dev):
+        return st.st_ino
+    key = f'{st.st_dev}:{st.st_ino}'
+    digest = hashlib.blake2b(key.encode('utf_8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') | (1 << 63)
+
+
+class LRUCache(object):
+    """Thread-safe least recently used cache with a bounded entry count.
+
+    The total length of the values can also be bounded. Hits, misses,
+    stale entries dropped on validation, expired entries, and evictions
+    are counted for reporting with stats().
+    """
+
+    def __init__(self, max_entries, ttl=None, max_bytes=None):
+        """Create the cache.
+
+        Parameters
+        ----------
+        max_entries : int
+            The maximum number of entries to hold. The least recently
+            used entries are evicted beyond this.
+        ttl : float or None (optional)
+            If provided, entries expire this many seconds after they
+            are stored.
+        max_bytes : int or None (optional)
+            If provided, the maximum total len() of the values held.
+            The least recently used entries are evicted beyond this,
+            though the most recent entry is always kept.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key, validate=None):
+        """Get the cached value for key.
+
+        Parameters
+        ----------
+        key : hashable
+            The cache key.
+        validate : callable (optional)
+            If provided, called with the cached value. If it returns
+            False, the entry is dropped and treated as a miss.
+
+        Raises
+        ------
+        KeyError
+            If the key is not cached or the entry is no longer valid.
+        """
+        with self._lock:
+            try:
+                stored, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            if(self.ttl is not None and time.monotonic() - stored > self.ttl):
+                self._remove(key)
+                self.expired += 1
+                self.misses += 1
+                raise KeyError(key)
+            self._entries.move_to_end(key)
+        if(validate is not None and not validate(value)):
+            with self._lock:
+                entry = self._entries.get(key)
+                if(entry is not None and entry[1] is value):
+                    self._remove(key)
+                self.stale += 1
+                self.misses += 1
+            raise KeyError(key)
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def _remove(self, key):
+        """Remove the entry for key, which must exist. Hold the lock."""
+        stored, value = self._entries.pop(key)
+        if(self.max_bytes is not None):
+            self._bytes -= len(value)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if(key in self._entries):
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), value)
+            if(self.max_bytes is not None):
+                self._bytes += len(value)
+            while(len(self._entries) > self.max_entries or
+                  (self.max_bytes is not None and self._bytes > self.max_bytes and
+                   len(self._entries) > 1)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pop(self, key, default=None):
+        """Remove the entry for key if present."""
+        with self._lock:
+            if(key not in self._entries):
+                return default
+            return self._remove(key)
+
+    def discard_where(self, predicate):
+        """Remove all entries whose key satisfies predicate."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove(key)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Get a dictionary of the cache counters."""
+        with self._lock:
+            stats = {'entries': len(self._entries),
+                     'max_entries': self.max_entries,
+                     'hits': self.hits,
+                     'misses': self.misses,
+                     'stale': self.stale,
+                     'expired': self.expired,
+                     'evictions': self.evictions,
+                     }
+            if(self.max_bytes is not None):
+                stats['bytes'] = self._bytes
+                stats['max_bytes'] = self.max_bytes
+            return stats
+
+
+class BackingStore(object):
+    """Metadata access to the mirrored filesystem with optional TTL caches.
+
+    On network filesystems every stat, listdir, and statvfs is a round
+    trip. Each call type can be given a time to live to reuse results
+    (including failures such as missing files) for that long, much like
+    the attribute caching of an NFS client. Call types without a time to
+    live go straight to the filesystem.
+    """
+
+    def __init__(self, stat_ttl=None, listdir_ttl=None, statvfs_ttl=None,
+                 max_entries=100000):
+        """Create the caches.
+
+        Parameters
+        ----------
+        stat_ttl : float or None (optional)
+            How many seconds to reuse stat and lstat results for.
+        listdir_ttl : float or None (optional)
+            How many seconds to reuse directory listings for.
+        statvfs_ttl : float or None (optional)
+            How many seconds to reuse filesystem stats for.
+        max_entries : int (optional)
+            The maximum number of entries for each call type.
+        """
+        self._caches = {}
+        for name, ttl in (('stat', stat_ttl), ('lstat', stat_ttl),
+                          ('listdir', listdir_ttl), ('statvfs', statvfs_ttl)):
+            if(ttl):
+                self._caches[name] = LRUCache(max_entries, ttl=ttl)
+
+    def _call(self, name, path):
+        """Get the result of os.{name}(path), cached if enabled."""
+        cache = self._caches.get(name)
+        if(cache is None):
+            return getattr(os, name)(path)
+        try:
+            result = cache.get(path)
+        except KeyError:
+            try:
+                result = getattr(os, name)(path)
+            except OSError as e:
+                result = e
+            cache[path] = result
+        if(isinstance(result, OSError)):
+            raise result
+        return result
+
+    def stat(self, path):
+        """Get os.stat for path."""
+        return self._call('stat', path)
+
+    def lstat(self, path):
+        """Get os.lstat for path."""
+        return self._call('lstat', path)
+
+    def listdir(self, path):
+        """Get os.listdir for path."""
+        return list(self._call('listdir', path))
+
+    def statvfs(self, path):
+        """Get os.statvfs for path."""
+        return self._call('statvfs', path)
+
+    def exists(self, path):
+        """Check whether path exists, following symbolic links."""
+        try:
+            self.stat(path)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def invalidate(self, directory):
+        """Drop the entries for a directory and the files in it."""
+        for cache in self._caches.values():
+            cache.discard_where(lambda key: key == directory or os.path.dirname(key) == directory)
+
+    def stats(self):
+        """Get the counters for each cached call type."""
+        return dict((name, cache.stats()) for name, cache in self._caches.items())
+
+
+class StreamInfo(object):
+    """The audio stream details needed to size and split tracks."""
+
+    __slots__ = ('sample_rate', 'channels', 'bits_per_sample', 'total_samples')
+
+    def __init__(self, sample_rate, channels, bits_per_sample, total_samples):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+        self.total_samples = total_samples
+
+    @property
+    def length(self):
+        """The length of the stream in seconds."""
+        return self.total_samples/self.sample_rate
+
+    @classmethod
+    def from_flac(cls, path):
+        """Read the stream info from the STREAMINFO block of a FLAC file.
+
+        Only the start of the file is read, skipping any ID3v2 tag.
+
+        Returns
+        -------
+        info : StreamInfo or None
+            The stream info, or None if path is not a FLAC file or does
+            not record its length.
+        """
+        with open(path, 'rb') as f:
+            header = f.read(10)
+            if(header[:3] == b'ID3' and len(header) == 10):
+                # Skip the ID3v2 tag (the size is 4 7-bit bytes), and its
+                # footer if present.
+                size = 0
+                for byte in header[6:10]:
+                    size = (size << 7) | (byte & 0x7F)
+                f.seek(10 + size + (10 if header[5] & 0x10 else 0))
+                header = f.read(10)
+            # STREAMINFO is always the first metadata block.
+            data = header + f.read(42 - len(header))
+        if(len(data) < 42 or data[:4] != b'fLaC' or data[4] & 0x7F != 0):
+            return None
+        # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per
+        # sample - 1, 36 bits total samples.
+        value = int.from_bytes(data[18:26], 'big')
+        total_samples = value & 0xFFFFFFFFF
+        sample_rate = value >> 44
+        if(total_samples == 0 or sample_rate == 0):
+            return None
+        return cls(sample_rate, ((value >> 41) & 0x7) + 1, ((value >> 36) & 0x1F) + 1,
+                   total_samples)
+
+    @classmethod
+    def from_file(cls, path):
+        """Read the stream info for an audio file.
+
+        FLAC files are read directly. Anything else uses mutagen.
+        """
+        try:
+            info = cls.from_flac(path)
+        except OSError:
+            info = None
+        if(info is not None):
+            return info
+        info = mutagen.File(path).info
+        try:
+            total_samples = info.total_samples
+        except AttributeError:
+            total_samples = int(round(info.length*info.sample_rate))
+        # Lossy formats have no bit depth. ffmpeg decodes those to 16 bit.
+        bits_per_sample = getattr(info, 'bits_per_sample', 16)
+        return cls(info.sample_rate, info.channels, bits_per_sample, total_samples)
+
+
+class Node(object):
+    """A file on the FLACCue filesystem, resolved from its path.
+
+    Nodes for tracks record everything needed to read the track, so a
+    path only has to be matched against the cue files once. The
+    attributes and stream info of the track are kept with the node
+    once computed.
+    """
+
+    __slots__ = ('path', 'split', 'source', 'times', 'meta', 'cue_file', 'signatures',
+                 'attrs', 'info')
+
+    def __init__(self, path, split=None, meta=None, cue_file=None, signatures=None):
+        """Create the node.
+
+        Parameters
+        ----------
+        path : str
+            The normalized path of the file.
+        split : str or None (optional)
+            For tracks, the path including the flaccuesplit details.
+        meta : TrackMeta or None (optional)
+            For tracks, the metadata for the track.
+        cue_file : str or None (optional)
+            For tracks, the cue file the track is from.
+        signatures : dict or None (optional)
+            For tracks, the signatures of the directory, cue file, and
+            base audio file when the track was resolved.
+        """
+        self.path = path
+        self.split = split
+        self.meta = meta
+        self.cue_file = cue_file
+        self.signatures = signatures
+        # Filled in by getattr and open.
+        self.attrs = None
+        self.info = None
+        if(split is None):
+            self.source = path
+            self.times = None
+        else:
+            source, details = split.split('.flaccuesplit.')
+            self.source = source
+            self.times = os.path.splitext(details)[0]
+
+    @property
+    def is_track(self):
+        """Whether the node is a track split from a cue file."""
+        return self.split is not None
+
+
+# How much ffmpeg output to read at a time when extracting tracks.
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+class TrackBuffer(object):
+    """The data of an extracted track, readable while it is extracted.
+
+    The data grows as it is appended. Reads wait only until the
+    requested range is available or the extraction has finished.
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._condition = threading.Condition()
+        self.complete = False
+        self.error = None
+
+    def __len__(self):
+        with self._condition:
+            return len(self._data)
+
+    def append(self, data):
+        """Add data to the end of the track."""
+        with self._condition:
+            self._data += data
+            self._condition.notify_all()
+
+    def finish(self, error=None):
+        """Mark the extraction as finished, or failed with error."""
+        with self._condition:
+            self.complete = True
+            self.error = error
+            self._condition.notify_all()
+
+    def read(self, offset, size):
+        """Read data from the track.
+
+        Waits until the range is available or the extraction has
+        finished. Ranges past the end of a finished track return
+        what is available.
+
+        Raises
+        ------
+        OSError
+            With EIO if the extraction failed before reaching the
+            range.
+        """
+        end = offset + size
+        with self._condition:
+            self._condition.wait_for(lambda: self.complete or len(self._data) >= end)
+            if(self.error is not None and len(self._data) < end):
+                raise OSError(errno.EIO, f'Extraction failed: {self.error}')
+            return bytes(self._data[offset:end])
+
+
+class DecodeQueue(object):
+    """A fixed number of worker threads running track extractions by priority.
+
+    Jobs are identified by a key (the buffer they fill) so a queued job
+    can be moved ahead later, e.g. when someone starts reading it. Queue
+    depth and the time jobs wait are counted for reporting with stats().
+    """
+
+    INTERACTIVE = 0
+    BULK = 1
+    _priority_names = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+    def __init__(self, workers):
+        """Start the worker threads.
+
+        Parameters
+        ----------
+        workers : int
+            The maximum number of jobs (ffmpeg processes) run at once.
+        """
+        self.workers = workers
+        self._heap = []
+        self._pending = {}
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.bumped = 0
+        self._waits = dict((name, [0, 0.0, 0.0]) for name in self._priority_names.values())
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+
+    def submit(self, key, job, priority=INTERACTIVE):
+        """Queue job() to run on a worker thread."""
+        with self._condition:
+            self._pending[key] = (priority, time.monotonic(), job)
+            heapq.heappush(self._heap, (priority, next(self._order), key))
+            self.max_queued = max(self.max_queued, len(self._pending))
+            self._condition.notify()
+
+    def pending(self, key):
+        """Check whether the job for key is still waiting to run."""
+        with self._condition:
+            return key in self._pending
+
+    def bump(self, key, priority=INTERACTIVE):
+        """Raise the priority of a waiting job."""
+        with self._condition:
+            entry = self._pending.get(key)
+            if(entry is None or entry[0] <= priority):
+                return
+            # The old heap entry is skipped when it comes up.
+            self._pending[key] = (priority,) + entry[1:]
+            heapq.heappush(self._heap, (priority, next(self._order), key))
+            self.bumped += 1
+
+    def _work(self):
+        while(True):
+            with self._condition:
+                self._condition.wait_for(lambda: self._heap)
+                priority, order, key = heapq.heappop(self._heap)
+                entry = self._pending.get(key)
+                if(entry is None or entry[0] != priority):
+                    # Already run, or bumped to a higher priority.
+                    continue
+                del self._pending[key]
+                priority, queued, job = entry
+                wait = time.monotonic() - queued
+                waits = self._waits[self._priority_names[priority]]
+                waits[0] += 1
+                waits[1] += wait
+                waits[2] = max(waits[2], wait)
+                self.running += 1
+            try:
+                job()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+            finally:
+                with self._condition:
+                    self.running -= 1
+                    self.completed += 1
+
+    def stats(self):
+        """Get the queue counters and wait times (in seconds) by priority."""
+        with self._condition:
+            return {'workers': self.workers,
+                    'queued': len(self._pending),
+                    'running': self.running,
+                    'max_queued': self.max_queued,
+                    'completed': self.completed,
+                    'bumped': self.bumped,
+                    'wait': dict((name, {'jobs': count, 'total': total, 'max': longest})
+                                 for name, (count, total, longest) in self._waits.items()),
+                    }
+
+
+class WindowedTrack(object):
+    """A WAV track decoded on demand in windows of samples.
+
+    Every byte of a WAV track maps directly to a sample of the base
+    file, so only the windows covering a read need decoding. Decoded
+    windows are kept in a cache shared between tracks. Reads and the
+    length match TrackBuffer.
+    """
+
+    def __init__(self, path, st, info, start, end, meta, window_samples, cache):
+        """Set up the track.
+
+        Parameters
+        ----------
+        path : str
+            The base audio file.
+        st : os.stat_result
+            The stat result for the base audio file.
+        info : StreamInfo
+            The stream info for the base audio file.
+        start, end : int
+            The first sample of the track and the sample after its end.
+        meta : TrackMeta or dict
+            The metadata for the WAV header.
+        window_samples : int
+            The number of samples decoded at a time.
+        cache : LRUCache
+            The cache of decoded windows.
+        """
+        self.path = path
+        self.info = info
+        self.start = start
+        self.end = end
+        self.window_samples = window_samples
+        self._cache = cache
+        self._signature = (st.st_mtime_ns, st.st_size)
+        self._block_align = info.channels*pcm_format(info.bits_per_sample)[2]
+        self._header = wav_header(info, end - start, meta)
+        self._size = len(self._header) + (end - start)*self._block_align
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def _window(self, index):
+        """Get the PCM data for a window of the track."""
+        first = self.start + index*self.window_samples
+        last = min(first + self.window_samples, self.end)
+        key = (self.path, self._signature, self.info.bits_per_sample, first, last)
+        try:
+            return self._cache.get(key)
+        except KeyError:
             pass
+        with self._lock:
+            # Another read may have decoded it while we waited.
+            try:
+                return self._cache.get(key)
+            except KeyError:
+                pass
+            pcm = decode_pcm(self.path, self.info, first, last)
+            self._cache[key] = pcm
+        return pcm
+
+    def read(self, offset, size):
+        """Read data from the track, decoding the windows it covers."""
+        end = min(offset + size, self._size)
+        data = self._header[offset:end]
+        offset = max(offset, len(self._header))
+        window_bytes = self.window_samples*self._block_align
+        while(offset < end):
+            position = offset - len(self._header)
+            index, window_offset = divmod(position, window_bytes)
+            window = self._window(index)
+            chunk = window[window_offset:window_offset + end - offset]
+            if(not chunk):
+                break
+            data += chunk
+            offset += len(chunk)
+        return data
+
+
+def split_samples(times, info):
+    """Get the sample range for the times of a FLACCue split path.
+
+    Parameters
+    ----------
+    times : str
+        The "{start_time}.{end_time}" portion of the split path, using
+        MM:SS:FF times. Invalid times (e.g. -1) mean the start or end
+        of the file.
+    info : StreamInfo
+        The stream info for the base file.
+
+    Returns
+    -------
+    start, end : int
+        The first sample of the track and the sample after its end.
+    """
+    start, end = (cue_time_to_frames(x) for x in times.split('.'))
+    # Cue sheet frames are a whole number of samples at all the usual
+    # sample rates, so this is exact.
+    start = 0 if start < 0 else start*info.sample_rate//FRAMES_PER_SECOND
+    if(end < 0):
+        end = info.total_samples
+    else:
+        end = min(end*info.sample_rate//FRAMES_PER_SECOND, info.total_samples)
+    start = min(start, info.total_samples)
+    return start, max(start, end)
+
+
+def pcm_format(bits_per_sample):
+    """Get the raw PCM output used for a bit depth.
+
+    Returns
+    -------
+    format : str
+        The ffmpeg raw output format.
+    codec : str
+        The ffmpeg audio codec.
+    width : int
+        The bytes per sample.
+    """
+    if(bits_per_sample <= 8):
+        return 'u8', 'pcm_u8', 1
+    if(bits_per_sample <= 16):
+        return 's16le', 'pcm_s16le', 2
+    if(bits_per_sample <= 24):
+        return 's24le', 'pcm_s24le', 3
+    return 's32le', 'pcm_s32le', 4
+
+
+# Speaker positions for WAVE_FORMAT_EXTENSIBLE, using the FLAC (and
+# ffmpeg) default channel layouts.
+channel_masks = {1: 0x4, 2: 0x3, 3: 0x7, 4: 0x33, 5: 0x37, 6: 0x3F, 7: 0x70F, 8: 0x63F}
+
+# KSDATAFORMAT_SUBTYPE_PCM
+pcm_subformat = bytes.fromhex('0100000000001000800000aa00389b71')
+
+# LIST INFO chunk ids for the track metadata. These match ffmpeg's WAV
+# muxer.
+info_tags = [(b'IART', 'artist'), (b'IPRD', 'album'), (b'INAM', 'title'), (b'IPRT', 'track')]
+
+
+def _riff_chunk(chunk_id, data):
+    """Build a RIFF chunk, padded to an even length."""
+    chunk = chunk_id + struct.pack('<I', len(data)) + data
+    if(len(data) % 2):
+        chunk += b'\0'
+    return chunk
+
+
+def wav_header(info, samples, meta=None):
+    """Build the WAV header for a track.
+
+    Parameters
+    ----------
+    info : StreamInfo
+        The stream info for the base file.
+    samples : int
+        The number of samples (per channel) in the track.
+    meta : TrackMeta or dict (optional)
+        The metadata to store in a LIST INFO chunk.
+
+    Returns
+    -------
+    header : bytes
+        Everything up to the start of the PCM data. The full file is
+        the header followed by the output of pcm_format.
+    """
+    fmt, codec, width = pcm_format(info.bits_per_sample)
+    block_align = info.channels*width
+    data_size = samples*block_align
+    fmt_chunk = struct.pack('<HIIHH', info.channels, info.sample_rate,
+                            info.sample_rate*block_align, block_align, width*8)
+    if(info.channels > 2 or width > 2):
+        # ffmpeg uses WAVE_FORMAT_EXTENSIBLE for these as well.
+        fmt_chunk = (struct.pack('<H', 0xFFFE) + fmt_chunk +
+                     struct.pack('<HHI', 22, width*8, channel_masks.get(info.channels, 0)) +
+                     pcm_subformat)
+    else:
+        fmt_chunk = struct.pack('<H', 1) + fmt_chunk
+    chunks = _riff_chunk(b'fmt ', fmt_chunk)
+    tags = b''
+    for chunk_id, name in info_tags:
+        value = getattr(meta, name, None)
+        if(value is not None and value != ''):
+            tags += _riff_chunk(chunk_id, str(value).encode('utf_8') + b'\0')
+    if(tags):
+        chunks += _riff_chunk(b'LIST', b'INFO' + tags)
+    riff_size = 4 + len(chunks) + 8 + data_size + (data_size % 2)
+    return (b'RIFF' + struct.pack('<I', riff_size) + b'WAVE' + chunks +
+            b'data' + struct.pack('<I', data_size))
+
+
+def decode_pcm(path, info, first, last):
+    """Decode a range of samples from an audio file to raw PCM.
+
+    Parameters
+    ----------
+    path : str
+        The audio file.
+    info : StreamInfo
+        The stream info for the file.
+    first, last : int
+        The first sample to decode and the sample after the last.
+
+    Returns
+    -------
+    pcm : bytes
+        Interleaved little endian samples in the pcm_format for the
+        bit depth, exactly (last - first) samples long.
+    """
+    fmt, codec, width = pcm_format(info.bits_per_sample)
+    # Seek on the input to the whole second before the range and trim
+    # the rest exactly.
+    seek = first//info.sample_rate
+    offset = seek*info.sample_rate
+    track = ffmpeg.input(path, ss=seek) if seek else ffmpeg.input(path)
+    output = track.audio.filter('atrim', start_sample=first - offset, end_sample=last - offset)
+    output = output.output('pipe:', format=fmt, acodec=codec)
+    pcm, _ = output.run(capture_stdout=True, quiet=True)
+    size = (last - first)*info.channels*width
+    return pcm[:size].ljust(size, b'\0')
+
+
+def _crc_table(poly, width):
+    """Build the lookup table for an MSB first CRC."""
+    table = []
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+
+_crc8_table = _crc_table(0x07, 8)
+_crc16_table = _crc_table(0x8005, 16)
+
+
+def crc8(data):
+    """Get the CRC-8 used by FLAC frame headers."""
+    crc = 0
+    for byte in data:
+        crc = _crc8_table[crc ^ byte]
+    return crc
+
+
+def crc16(data):
+    """Get the CRC-16 used by FLAC frames."""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _crc16_table[(crc >> 8) ^ byte]
+    return crc
+
+
+def _crc16_mulmod(a, b):
+    """Multiply two polynomials modulo the FLAC CRC-16 polynomial."""
+    result = 0
+    while(b):
+        if(b & 1):
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if(a & 0x10000):
+            a ^= 0x18005
+    return result
+
+
+# x^(8*2^k) modulo the CRC-16 polynomial, for shifting a CRC past bytes.
+_crc16_byte_powers = [0x100]
+for _ in range(40):
+    _crc16_byte_powers.append(_crc16_mulmod(_crc16_byte_powers[-1], _crc16_byte_powers[-1]))
+
+
+def crc16_shift(crc, size):
+    """Get the CRC-16 of a message followed by size zero bytes.
+
+    FLAC's CRC-16 has no initial value or final XOR, so it is linear:
+    the CRC of A followed by B is crc16_shift(crc16(A), len(B)) ^ crc16(B).
+    This lets a frame header be replaced without reading the whole
+    frame again.
+    """
+    k = 0
+    while(size):
+        if(size & 1):
+            crc = _crc16_mulmod(crc, _crc16_byte_powers[k])
+        size >>= 1
+        k += 1
+    return crc
+
+
+def _flac_number(value):
+    """Encode a FLAC frame or sample number (UTF-8 style)."""
+    if(value < 0x80):
+        return bytes([value])
+    length = 2
+    while(value >= 1 << (5*length + 1)):
+        length += 1
+    data = bytearray()
+    for _ in range(length - 1):
+        data.insert(0, 0x80 | (value & 0x3F))
+        value >>= 6
+    data.insert(0, ((0xFF00 >> length) & 0xFF) | value)
+    return bytes(data)
+
+
+class FLACFrames(object):
+    """Locate the frames of a FLAC file.
+
+    Frame headers are found by their sync code, checked with their
+    CRC-8, and confirmed by the next frame starting with the expected
+    sample number. The file is memory mapped, so only the pages around
+    the frames used are read.
+    """
+
+    # Block sizes for the 4 bit block size codes. None means the size
+    # is stored at the end of the header.
+    _block_sizes = [None, 192, 576, 1152, 2304, 4608, None, None,
+                    256, 512, 1024, 2048, 4096, 8192, 16384, 32768]
+
+    def __init__(self, f):
+        """Read the metadata of an open FLAC file.
+
+        Raises
+        ------
+        ValueError
+            If the file is not a FLAC file.
+        """
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mm
+        position = 0
+        if(mm[:3] == b'ID3'):
+            size = 0
+            for byte in mm[6:10]:
+                size = (size << 7) | (byte & 0x7F)
+            position = 10 + size + (10 if mm[5] & 0x10 else 0)
+        if(mm[position:position + 4] != b'fLaC'):
+            raise ValueError('Not a FLAC file.')
+        position += 4
+        # Metadata blocks as (type, data).
+        self.blocks = []
+        last = False
+        while(not last):
+            header = mm[position:position + 4]
+            if(len(header) < 4):
+                raise ValueError('Truncated FLAC metadata.')
+            last = bool(header[0] & 0x80)
+            length = int.from_bytes(header[1:4], 'big')
+            self.blocks.append((header[0] & 0x7F, mm[position + 4:position + 4 + length]))
+            position += 4 + length
+        streaminfo = self.blocks[0][1]
+        if(self.blocks[0][0] != 0 or len(streaminfo) < 34):
+            raise ValueError('Missing FLAC STREAMINFO.')
+        self.first_frame = position
+        self.min_block_size, self.max_block_size = struct.unpack('>HH', streaminfo[:4])
+        value = int.from_bytes(streaminfo[10:18], 'big')
+        self.total_samples = value & 0xFFFFFFFFF
+        self.end = len(mm)
+        if(mm[self.end - 128:self.end - 125] == b'TAG'):
+            # ID3v1 tag after the audio.
+            self.end -= 128
+        # All frames use the blocking strategy of the first.
+        self.variable = self._header(self.first_frame) is not None and bool(mm[self.first_frame + 1] & 1)
+        self._sync = b'\xff\xf9' if self.variable else b'\xff\xf8'
+
+    def close(self):
+        self._mm.close()
+
+    def _header(self, position):
+        """Parse the frame header at position.
+
+        Returns
+        -------
+        header : tuple or None
+            (header length, first sample, block size), or None if this
+            is not a valid frame header.
+        """
+        header = self._mm[position:position + 16]
+        if(len(header) < 6 or header[0] != 0xFF or header[1] & 0xFE != 0xF8):
+            return None
+        block_code = header[2] >> 4
+        rate_code = header[2] & 0xF
+        if(block_code == 0 or rate_code == 15 or header[3] >> 4 > 10 or header[3] & 1):
+            return None
+        # The frame or sample number.
+        first = header[4]
+        length = 0
+        while(length < 7 and first & (0x80 >> length)):
+            length += 1
+        if(length == 1 or length > 7):
+            return None
+        if(length == 0):
+            number = first
+            length = 1
+        else:
+            number = first & (0x7F >> length)
+            for byte in header[5:4 + length]:
+                if(byte & 0xC0 != 0x80):
+                    return None
+                number = (number << 6) | (byte & 0x3F)
+        end = 4 + length
+        block_size = self._block_sizes[block_code]
+        if(block_code == 6):
+            block_size = header[end] + 1
+            end += 1
+        elif(block_code == 7):
+            block_size = int.from_bytes(header[end:end + 2], 'big') + 1
+            end += 2
+        if(rate_code == 12):
+            end += 1
+        elif(rate_code in (13, 14)):
+            end += 2
+        if(end >= len(header) or crc8(header[:end]) != header[end]):
+            return None
+        if(not header[1] & 1):
+            # Fixed block size streams number frames rather than samples.
+            number *= self.max_block_size
+        return end + 1, number, block_size
+
+    def _find(self, position, limit, sample=None):
+        """Find the next frame header at or after position.
+
+        Parameters
+        ----------
+        position, limit : int
+            The range of file offsets to search.
+        sample : int or None (optional)
+            If provided, only a frame starting at this sample matches.
+
+        Returns
+        -------
+        frame : tuple or None
+            (offset, header length, first sample, block size).
+        """
+        while(True):
+            position = self._mm.find(self._sync, position, limit)
+            if(position < 0):
+                return None
+            header = self._header(position)
+            if(header is not None and (sample is None or header[1] == sample)):
+                return (position,) + header
+            position += 1
+
+    def _next(self, frame):
+        """Get the frame after frame, or None at the end of the stream."""
+        offset, header_length, first, block_size = frame
+        if(first + block_size >= self.total_samples):
+            return None
+        return self._find(offset + header_length, self.end, first + block_size)
+
+    def _confirmed(self, position, limit):
+        """Find the next frame at or after position that is followed by the expected frame."""
+        while(True):
+            frame = self._find(position, limit)
+            if(frame is None):
+                return None
+            following = self._next(frame)
+            if(following is not None or frame[2] + frame[3] >= self.total_samples):
+                return frame
+            position = frame[0] + 1
+
+    def frames(self, start, end):
+        """Get the frames covering a range of samples.
+
+        Parameters
+        ----------
+        start, end : int
+            The first sample and the sample after the last.
+
+        Returns
+        -------
+        frames : list
+            (offset, header length, first sample, block size, end
+            offset) for each frame from the one containing start to
+            the one containing end - 1.
+        """
+        # Bisect on the file offset for a frame at or before start.
+        frame = self._find(self.first_frame, self.end)
+        if(frame is None):
+            raise ValueError('No FLAC frames found.')
+        low, high = frame[0], self.end
+        while(high - low > 1 << 16):
+            middle = (low + high)//2
+            candidate = self._confirmed(middle, high)
+            if(candidate is None or candidate[2] > start):
+                high = middle
+            else:
+                frame = candidate
+                low = candidate[0]
+        # Walk forward frame by frame.
+        while(frame[2] + frame[3] <= start):
+            frame = self._next(frame)
+            if(frame is None):
+                raise ValueError('Track starts after the end of the FLAC stream.')
+        frames = []
+        while(True):
+            following = self._next(frame)
+            frames.append(frame + (following[0] if following is not None else self.end,))
+            if(following is None or following[2] >= end):
+                return frames
+            frame = following
+
+    def copy(self, frame, sample):
+        """Copy a frame, renumbering it to start at sample.
+
+        The header is rewritten for a variable block size stream, and
+        the frame's CRC-16 is updated for the new header without
+        reading the rest of the frame.
+        """
+        offset, header_length, first, block_size, end = frame
+        mm = self._mm
+        old_header = mm[offset:offset + header_length]
+        # Skip past the old number (its length is the count of leading one
+        # bits of its first byte) to the optional fields.
+        ones = 0
+        while(ones < 8 and old_header[4] & (0x80 >> ones)):
+            ones += 1
+        number_end = 4 + max(ones, 1)
+        header = (b'\xff\xf9' + old_header[2:4] + _flac_number(sample) +
+                  old_header[number_end:header_length - 1])
+        header += bytes([crc8(header)])
+        body = end - offset - header_length - 2
+        crc = int.from_bytes(mm[end - 2:end], 'big')
+        crc ^= crc16_shift(crc16(old_header) ^ crc16(header), body)
+        return header + mm[offset + header_length:end - 2] + crc.to_bytes(2, 'big')
+
+
+def verbatim_frame(sample, pcm, info):
+    """Encode PCM as a FLAC frame using verbatim subframes.
+
+    Parameters
+    ----------
+    sample : int
+        The sample number of the frame in a variable block size stream.
+    pcm : bytes
+        Interleaved samples as output for pcm_format.
+    info : StreamInfo
+        The stream info, for the channels and bit depth.
+    """
+    fmt, codec, width = pcm_format(info.bits_per_sample)
+    channels = info.channels
+    bits = info.bits_per_sample
+    block_size = len(pcm)//(channels*width)
+    # Block size as 16 bits at the end of the header. Sample rate, bit
+    # depth from STREAMINFO. Independent channels.
+    header = (b'\xff\xf9' + bytes([0x70, (channels - 1) << 4]) + _flac_number(sample) +
+              (block_size - 1).to_bytes(2, 'big'))
+    header += bytes([crc8(header)])
+    shift = 8*width - bits
+    mask = (1 << bits) - 1
+    subframes = []
+    for channel in range(channels):
+        samples = []
+        for i in range(channel*width, len(pcm), channels*width):
+            if(width == 1):
+                value = pcm[i] - 128
+            else:
+                value = int.from_bytes(pcm[i:i + width], 'little', signed=True)
+            samples.append(format((value >> shift) & mask, f'0{bits}b'))
+        # Zero padding bit, verbatim type, no wasted bits.
+        subframes.append('00000010' + ''.join(samples))
+    bitstring = ''.join(subframes)
+    bitstring += '0'*(-len(bitstring) % 8)
+    frame = header + int(bitstring, 2).to_bytes(len(bitstring)//8, 'big')
+    return frame + crc16(frame).to_bytes(2, 'big')
+
+
+def _metadata_block(block_type, data, last=False):
+    """Build a FLAC metadata block."""
+    return bytes([block_type | (0x80 if last else 0)]) + len(data).to_bytes(3, 'big') + data
+
+
+# Vorbis comment names for the track metadata. These match the names
+# ffmpeg writes.
+vorbis_tags = [('ARTIST', 'artist'), ('ALBUM', 'album'), ('DISCNUMBER', 'disc'),
+               ('TRACKNUMBER', 'track'), ('TITLE', 'title')]
+
+
+def split_flac(path, info, start, end, meta=None, seek_interval=10):
+    """Build a FLAC file for a range of samples by copying frames.
+
+    Frames entirely inside the range are copied without decoding. Only
+    the partial frames at either end are decoded and stored verbatim.
+    The output has a new STREAMINFO, SEEKTABLE, and VORBIS_COMMENT, and
+    keeps any PICTURE blocks of the source.
+
+    Parameters
+    ----------
+    path : str
+        The FLAC file.
+    info : StreamInfo
+        The stream info for the file.
+    start, end : int
+        The first sample of the track and the sample after its end.
+    meta : TrackMeta or dict (optional)
+        The metadata to store in the VORBIS_COMMENT block.
+    seek_interval : float (optional)
+        The seconds between seek points.
+
+    Returns
+    -------
+    data : bytes
+        The FLAC file.
+
+    Raises
+    ------
+    ValueError
+        If the file is not a FLAC file that can be split.
+
+    Notes
+    -----
+    An empty range (start == end) gives a FLAC file with only the
+    metadata blocks.
+    """
+    with open(path, 'rb') as f:
+        source = FLACFrames(f)
+        try:
+            # An empty range has no frames to copy.
+            frames = source.frames(start, end) if start < end else []
+            # (output frame, first sample in the output, block size)
+            output = []
+            position = start
+            index = 0
+            while(index < len(frames)):
+                offset, header_length, first, block_size, frame_end = frames[index]
+                last = first + block_size
+                if(first >= start and last <= end):
+                    output.append((source.copy(frames[index], position - start),
+                                   position - start, block_size))
+                    position = last
+                    index += 1
+                    continue
+                # A partial frame. Re-encode it, along with the next frame if
+                # it would otherwise be below the 16 sample minimum block size.
+                stop = min(last, end)
+                if(stop - position < 16 and stop < end and index + 1 < len(frames)):
+                    index += 1
+                    offset, header_length, first, block_size, frame_end = frames[index]
+                    stop = min(first + block_size, end)
+                pcm = decode_pcm(path, info, position, stop)
+                output.append((verbatim_frame(position - start, pcm, info),
+                               position - start, stop - position))
+                position = stop
+                index += 1
+            pictures = [data for block_type, data in source.blocks if block_type == 6]
+        finally:
+            source.close()
+    if(output):
+        block_sizes = [block_size for frame, sample, block_size in output]
+        frame_sizes = [len(frame) for frame, sample, block_size in output]
+        # The last block may be short.
+        block_range = (min(block_sizes[:-1] or block_sizes), max(block_sizes))
+        frame_range = (min(frame_sizes), max(frame_sizes))
+    else:
+        # An empty range gives a file with no frames. The block sizes
+        # must still be valid. Zero frame sizes mean unknown.
+        block_range = (4096, 4096)
+        frame_range = (0, 0)
+    streaminfo = (struct.pack('>HH', *block_range) +
+                  frame_range[0].to_bytes(3, 'big') + frame_range[1].to_bytes(3, 'big') +
+                  ((info.sample_rate << 44) | ((info.channels - 1) << 41) |
+                   ((info.bits_per_sample - 1) << 36) | (end - start)).to_bytes(8, 'big') +
+                  # The MD5 signature is unknown.
+                  bytes(16))
+    # A seek point for the frame holding each multiple of seek_interval.
+    interval = int(seek_interval*info.sample_rate)
+    seektable = b''
+    frame_offset = 0
+    target = 0
+    for frame, sample, block_size in output:
+        if(sample + block_size > target):
+            seektable += struct.pack('>QQH', sample, frame_offset, block_size)
+            target = (sample//interval + 1)*interval
+        frame_offset += len(frame)
+    vendor = b'FLACCue'
+    comments = []
+    for name, attribute in vorbis_tags:
+        value = getattr(meta, attribute, None)
+        if(value is not None and value != ''):
+            comments.append(f'{name}={value}'.encode('utf_8'))
+    vorbis_comment = (struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments)) +
+                      b''.join(struct.pack('<I', len(comment)) + comment for comment in comments))
+    blocks = [(0, streaminfo), (3, seektable)] + [(6, data) for data in pictures] + [(4, vorbis_comment)]
+    data = [b'fLaC']
+    for i, (block_type, block) in enumerate(blocks):
+        data.append(_metadata_block(block_type, block, last=i == len(blocks) - 1))
+    data.extend(frame for frame, sample, block_size in output)
+    return b''.join(data)
+
+
+class DirectoryWatcher(object):
+    """Watch directories for changes using Linux inotify.
+
+    Each watched directory reports files created, deleted, moved, or
+    finished being written. The callback is called from a background
+    thread with the directory path and the changed filename.
+    """
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    # struct inotify_event: int wd; uint32_t mask, cookie, len; char name[];
+    _event = struct.Struct('iIII')
+
+    def __init__(self, callback):
+        """Start watching.
+
+        Parameters
+        ----------
+        callback : callable
+            Called as callback(directory, name) for each change. The
+            name is None if the whole directory changed or events were
+            lost.
+        """
+        self._callback = callback
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_CLOEXEC)
+        if(self._fd < 0):
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._lock = threading.Lock()
+        self._directories = {}
+        self._watches = {}
+        self._full = False
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def watch(self, directory):
+        """Start watching directory if it is not already watched."""
+        with self._lock:
+            if(directory in self._watches or self._full):
+                return
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+            if(wd < 0):
+                error = ctypes.get_errno()
+                if(error == errno.ENOSPC):
+                    # Out of inotify watches. Caches are still validated
+                    # against modification times, so just stop adding more.
+                    self._full = True
+                    print('Out of inotify watches. Increase fs.inotify.max_user_watches '
+                          'to watch more directories.', file=sys.stderr, flush=True)
+                return
+            self._watches[directory] = wd
+            self._directories[wd] = directory
+
+    def watching(self, directory):
+        """Check whether changes in directory are being reported.
+
+        Directories that could not be watched (e.g. after running out
+        of inotify watches) or whose watch was removed are not.
+        """
+        with self._lock:
+            return directory in self._watches
+
+    def _run(self):
+        """Read and dispatch inotify events."""
+        while(True):
+            data = os.read(self._fd, 65536)
+            offset = 0
+            while(offset < len(data)):
+                wd, mask, cookie, length = self._event.unpack_from(data, offset)
+                offset += self._event.size
+                name = data[offset:offset+length].rstrip(b'\0')
+                offset += length
+                if(mask & self.IN_Q_OVERFLOW):
+                    # Events were lost. Treat everything as changed.
+                    with self._lock:
+                        directories = list(self._watches)
+                    for directory in directories:
+                        self._dispatch(directory, None)
+                    continue
+                with self._lock:
+                    directory = self._directories.get(wd)
+                    if(mask & self.IN_IGNORED and directory is not None):
+                        # The watch was removed (e.g. directory deleted).
+                        del self._directories[wd]
+                        del self._watches[directory]
+                if(directory is None):
+                    continue
+                self._dispatch(directory, os.fsdecode(name) if name else None)
+
+    def _dispatch(self, directory, name):
+        """Call the callback, reporting rather than raising errors."""
+        try:
+            self._callback(directory, name)
+        except Exception:
+            print(f'Error handling changes in {directory}:', file=sys.stderr, flush=True)
+            import traceback
+            traceback.print_exc()
+
+
+class CueIndex(object):
+    """Persistent index of parsed cue files and extracted track sizes.
+
+    The parsed results are stored in an SQLite database keyed by the
+    cue filename and output format, and are only returned while the
+    modification time and size of the cue file still match. This lets
+    a restarted filesystem answer directory listings without parsing
+    every cue file again.
+    """
+
+    # Increased when the stored results change meaning. Older rows are
+    # dropped. Version 1 stores tracks whether or not their audio file
+    # exists.
+    VERSION = 1
+
+    def __init__(self, filename):
+        """Open (or create) the index.
+
+        Parameters
+        ----------
+        filename : str
+            The SQLite database file used to store the index.
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # FUSE calls come in from many threads. The lock serializes
+        # access to the single connection.
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS cues ('
+                             'path TEXT NOT NULL, format TEXT NOT NULL, '
+                             'mtime INTEGER NOT NULL, size INTEGER NOT NULL, '
+                             'parsed BLOB NOT NULL, PRIMARY KEY (path, format))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS sizes ('
+                             'path TEXT NOT NULL, format TEXT NOT NULL, '
+                             'mtime INTEGER NOT NULL, size INTEGER NOT NULL, '
+                             'output_size INTEGER NOT NULL, PRIMARY KEY (path, format))')
+            if(self._db.execute('PRAGMA user_version').fetchone()[0] < self.VERSION):
+                self._db.execute('DELETE FROM cues')
+                self._db.execute(f'PRAGMA user_version = {self.VERSION}')
+            self._db.commit()
+
+    def get(self, cue_file, format, st):
+        """Get the stored parse of the cue file.
+
+        Parameters
+        ----------
+        cue_file : str
+            The cue filename.
+        format : str
+            The output format the parse was generated for.
+        st : os.stat_result
+            The current stat details for the cue file.
+
+        Returns
+        -------
+        parsed : tuple or None
+            The stored (to_add, meta, to_remove) results, or None if
+            the cue file is not in the index or has changed.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT mtime, size, parsed FROM cues '
+                                   'WHERE path = ? AND format = ?',
+                                   (cue_file, format)).fetchone()
+        if(row is None or row[0] != st.st_mtime_ns or row[1] != st.st_size):
+            return None
+        try:
+            return pickle.loads(row[2])
+        except Exception:
+            # Stored by an incompatible version. Parse it again.
+            return None
+
+    def put(self, cue_file, format, st, parsed):
+        """Store the parse of the cue file.
+
+        Parameters
+        ----------
+        cue_file : str
+            The cue filename.
+        format : str
+            The output format the parse was generated for.
+        st : os.stat_result
+            The stat details for the cue file when it was parsed.
+        parsed : tuple
+            The (to_add, meta, to_remove) results to store.
+        """
+        data = pickle.dumps(parsed, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO cues VALUES (?, ?, ?, ?, ?)',
+                             (cue_file, format, st.st_mtime_ns, st.st_size, data))
+            self._db.commit()
+
+    def discard(self, directory):
+        """Drop the stored parses of the cue files in a directory."""
+        directory = directory.rstrip(os.sep)
+        with self._lock:
+            # All paths below the directory sort between these.
+            rows = self._db.execute('SELECT path FROM cues WHERE path > ? AND path < ?',
+                                    (directory + os.sep, directory + chr(ord(os.sep) + 1))).fetchall()
+            paths = [(path,) for path, in rows if os.path.dirname(path) == directory]
+            if(paths):
+                self._db.executemany('DELETE FROM cues WHERE path = ?', paths)
+                self._db.commit()
+
+    def get_size(self, path, format, st):
+        """Get the recorded size of an extracted track.
+
+        Parameters
+        ----------
+        path : str
+            The track filename on the FLACCue filesystem.
+        format : str
+            The output format of the track.
+        st : os.stat_result
+            The current stat details for the base audio file.
+
+        Returns
+        -------
+        size : int or None
+            The size in bytes, or None if not recorded or the base
+            file has changed.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT mtime, size, output_size FROM sizes '
+                                   'WHERE path = ? AND format = ?',
+                                   (path, format)).fetchone()
+        if(row is None or row[0] != st.st_mtime_ns or row[1] != st.st_size):
+            return None
+        return row[2]
 
-    if(lines is None):
-        raise UnicodeError('Unable to find appropriate encoding for input file.')
+    def put_size(self, path, format, st, output_size):
+        """Record the size of an extracted track.
 
-    cue = {}
-    cue['Files'] = {}
-    # Line index. We don't use a for loop as we will
-    # read multiple lines for information.
-    i = 0
-    try:
-        while(True):
-            # We have a FILE specification in the Cue sheet.
-            if(lines[i].startswith('FILE')):
-                # Get the filename.
-                filename = lines[i].split('"')[1]
-                # Now we will parse the tracks from the file.
-                # Use a local variable name for clarity.
-                file_details = {}
-                # But store that variable in the cue sheet parse dictionary.
-                cue['Files'][filename] = file_details
-                # Create the Track entry to store tracks from the file.
-                file_details['Tracks'] = {}
-                # Start at the next line.
-                i += 1
-                # Use the Cue sheet indentation for sectioning. 2 spaces for
-                # TRACK entries in the FILE entry.
-                while(lines[i].startswith(' '*2)):
-                    # Get rid of extra white space.
-                    line = lines[i].strip()
-                    # Handle TRACK entries.
-                    if(line.startswith('TRACK')):
-                        # Get the track number.
-                        track = int(line.split()[1])
-                        # Use a local variable name for clarity.
-                        track_details = {}
-                        # But store that variable in the cue sheet parse dictionary.
-                        file_details['Tracks'][track] = track_details
-                        # Create the INDEX dictionary to store track indices.
-                        track_details['INDEX'] = {}
-                        # Start at the next line.
-                        i += 1
-                        # Use the Cue sheet indentation for sectioning. 4 spaces
-                        # for INDEX entries in the TRACK entry.
-                        while(lines[i].startswith(' '*4)):
-                            # Get rid of extra white space.
-                            line = lines[i].strip()
-                            # Find the index entries.
-                            if(line.startswith('INDEX')):
-                                # Remove the INDEX text and extra white space.
-                                line = line[5:].strip()
-                                # Get the INDEX number and the rest of the line.
-                                # The rest of the line should be the time information.
-                                key, value = line.split(None, 1)
-                                # Store the time information for this index.
-                                track_details['INDEX'][int(key)] = value.strip().replace('"', '')
-                                i += 1
-                            else:
-                                # Store all the other entries as text. Use the first
-                                # word as the access key.
-                                key, value = line.split(None, 1)
-                                # Also remove quotes from track names and similar.
-                                track_details[key] = value.strip().replace('"', '')
-                                i += 1
-                    else:
-                        # Store all the other entries as text. Use the first
-                        # word as the access key.
-                        key, value = lines[i].split(None, 1)
-                        # Also remove quotes from track names and similar.
-                        file_details[key] = value.strip().replace('"', '')
-                        i += 1
-            else:
-                # Store all the other entries as text. Use the first
-                # word as the access key.
-                key, value = lines[i].split(None, 1)
-                # Also remove quotes from track names and similar.
-                cue[key] = value.strip().replace('"', '')
-                i += 1
-    except IndexError:
-        # We're done.
-        pass
-    return cue
+        Parameters
+        ----------
+        path : str
+            The track filename on the FLACCue filesystem.
+        format : str
+            The output format of the track.
+        st : os.stat_result
+            The stat details for the base audio file.
+        output_size : int
+            The size of the extracted track in bytes.
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?, ?)',
+                             (path, format, st.st_mtime_ns, st.st_size, output_size))
+            self._db.commit()
 
 
 class FLACCue(fuse.LoggingMixIn, fuse.Operations):
     """FUSE filesystem to parse .cue files into separate tracks."""
 
-    def __init__(self, root, mount, format='wav', use_tempfile=False, cache_cue=True, verbose=False):
+    def __init__(self, root, mount, format='wav', use_tempfile=False, cache_cue=True,
+                 cue_cache_size=10000, dir_cache_size=20000,
+                 negative_cache_size=10000, negative_ttl=30, attr_cache_size=10000,
+                 attr_ttl=5, info_cache_size=10000, size_cache_size=100000,
+                 node_cache_size=200000, index=None,
+                 preindex=None, preindex_workers=None, preindex_nice=10, watch=False,
+                 manifest_dir=None, keep_cache=True, stat_ttl=None, listdir_ttl=None,
+                 statvfs_ttl=None, random_access=False, window_seconds=5,
+                 window_cache_size=64, window_cache_mb=128, split_frames=False, decode_workers=2,
+                 bulk_processes=('Plex Media Scan',), verbose=False):
         """Initialize the filesystem for the root path.
 
         Parameters
@@ -247,26 +2368,147 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
         cache_cue : bool
             If True, cache parsed cue files. Otherwise, parse
             cue files every time the filesystem accesses them.
+            Cached entries are checked against the modification time
+            and size of the cue file so edits are picked up.
+        cue_cache_size : int
+            The maximum number of parsed cue files to cache.
+        dir_cache_size : int
+            The maximum number of directories to cache the tracks of
+            all cue files for.
+        negative_cache_size : int
+            The maximum number of paths to remember as matching no
+            file or track.
+        negative_ttl : float
+            How many seconds paths are remembered as matching no file
+            or track.
+        attr_cache_size : int
+            The maximum number of file attributes from directory
+            listings to keep for getattr.
+        attr_ttl : float
+            How many seconds file attributes from directory listings
+            are used for getattr, and the stat results for the files
+            in a directory are used for listings.
+        info_cache_size : int
+            The maximum number of audio files to cache the stream info
+            (sample rate, channels, etc.) for.
+        size_cache_size : int
+            The maximum number of extracted track sizes to keep for
+            compressed formats.
+        node_cache_size : int
+            The maximum number of resolved tracks (with their
+            attributes) to keep.
+        index : str or None
+            If provided, the filename of a persistent index of parsed
+            cue files. Parsed cue files are stored there and reused
+            after a restart as long as the cue file is unchanged.
+        preindex : list of str or None
+            If provided, directories to search for cue files when the
+            filesystem is mounted. These are parsed in the background
+            to fill the cue cache and index before they are accessed.
+        preindex_workers : int or None
+            The number of processes used to parse cue files in the
+            background. Defaults to the number of CPUs.
+        preindex_nice : int
+            The niceness added to the background parsing processes.
+        watch : bool
+            If True, use inotify to watch directories with cached
+            entries and drop the affected entries as soon as files
+            in those directories change.
+        manifest_dir : str or None
+            If provided, write a manifest of the tracks split from the
+            cue files in each directory under this directory. The Plex
+            scanner in flaccuelib.py reads these instead of parsing the
+            cue files itself.
+        keep_cache : bool
+            If True, let the kernel keep the page cache of split tracks
+            between opens, so repeat reads do not reach FLACCue. Tracks
+            are only extracted once a read reaches FLACCue. The cache
+            is dropped when the base file or cue file has changed since
+            the last open. This only applies when mounted with
+            raw_fi=True.
+        stat_ttl : float or None
+            If provided, reuse stat results from the mirrored
+            filesystem (including missing files) for this many seconds.
+            Useful when the root is on a network filesystem.
+        listdir_ttl : float or None
+            If provided, reuse directory listings from the mirrored
+            filesystem for this many seconds.
+        statvfs_ttl : float or None
+            If provided, reuse filesystem stats from the mirrored
+            filesystem for this many seconds.
+        random_access : bool
+            If True and the format is 'wav', decode only the parts of
+            a track that are read instead of the whole track from its
+            start.
+        window_seconds : float
+            With random_access, the length of audio decoded at a time.
+        window_cache_size : int
+            With random_access, the maximum number of decoded windows
+            to keep in memory.
+        window_cache_mb : float
+            With random_access, the maximum megabytes (MiB) of decoded
+            windows to keep in memory. Windows of high resolution audio
+            are much larger, so this bounds the memory used whatever
+            the stream format.
+        split_frames : bool
+            If True and the format is 'flac', build tracks from FLAC
+            files by copying their frames. Only the partial frames at
+            the track boundaries are decoded.
+        decode_workers : int
+            The maximum number of tracks extracted at once.
+        bulk_processes : sequence of str
+            Process names (as in /proc/<pid>/comm) whose opens are bulk
+            work, such as library scans. Their tracks are extracted
+            after those opened by anything else, e.g. for playback.
         verbose : bool
             If True, print out extra information that may be useful
             for debugging.
         """
         self.root = os.path.realpath(root)
         self.mount = os.path.realpath(mount)
+        self._root_dev = os.stat(self.root).st_dev
         self.rwlock = threading.RLock()
         self._open_subtracks = {}
         self._format = format
         self._verbose = verbose
         self._use_tempfile = use_tempfile
+        self._keep_cache = keep_cache
+        # The signatures of tracks when they were last opened, so cached
+        # pages are only kept while they are current.
+        self._page_signatures = LRUCache(node_cache_size)
+        self._backing = BackingStore(stat_ttl=stat_ttl, listdir_ttl=listdir_ttl,
+                                     statvfs_ttl=statvfs_ttl)
+        self._window_seconds = window_seconds
+        self._window_cache = (LRUCache(window_cache_size, max_bytes=int(window_cache_mb*2**20))
+                              if random_access else None)
+        self._split_frames = split_frames
+        self._decoder = DecodeQueue(decode_workers)
+        self._bulk_processes = tuple(bulk_processes)
         if(cache_cue):
-            self._cue_cache = {}
-            self._track_cache = {}
+            self._cue_cache = LRUCache(cue_cache_size)
+            self._dir_index = LRUCache(dir_cache_size)
+            self._dir_stats = LRUCache(dir_cache_size, ttl=attr_ttl)
+            self._negative_cache = LRUCache(negative_cache_size, ttl=negative_ttl)
+            self._attr_cache = LRUCache(attr_cache_size, ttl=attr_ttl)
+            self._info_cache = LRUCache(info_cache_size)
+            self._size_cache = LRUCache(size_cache_size)
+            self._nodes = LRUCache(node_cache_size)
+        self._index = CueIndex(index) if index is not None else None
+        self._preindex = preindex
+        self._preindex_workers = preindex_workers
+        self._preindex_nice = preindex_nice
+        self._watcher = DirectoryWatcher(self.invalidate) if watch else None
+        self._manifest_dir = manifest_dir
+        self._manifest_lock = threading.Lock()
+        # The signatures of the cue files whose manifest entries are up
+        # to date, so repeat lookups don't read the manifest again.
+        self._manifests_written = LRUCache(cue_cache_size)
 
     def __call__(self, op, path, *args, **pargs):
         """Transfer any call to this filesystem to include the root path."""
         return super(FLACCue, self).__call__(op, os.path.join(self.root, path), *args)
 
-    def get_cue_files(self, cue_file, verbose=False):
+    def get_cue_files(self, cue_file, verbose=False, st=None):
         """Get details on the files referenced by the cue file.
 
         Parameters
@@ -276,6 +2518,8 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
         verbose : bool (optional)
             If True, print out extra information on the parsed
             cue file.
+        st : os.stat_result (optional)
+            The stat result for the cue file if already known.
 
         Returns
         -------
@@ -284,115 +2528,220 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
             indexing filenames for extracting the tracks from
             the raw audio files.
         meta : dict
-            Dictionary of metadata for each file generated from
+            Dictionary of TrackMeta for each file generated from
             the cue sheet. This is intended to pass to ffmpeg
             during processing to update the metadata in the
             output header.
         to_remove : list
             List of files referenced by the cue file. These are
             intended for removal from the directory listing.
+
+        Notes
+        -----
+        Only audio files that currently exist are included. The cache
+        and index hold the results for every referenced file, so audio
+        files added after the cue file show up without parsing it
+        again.
+        """
+        if(st is None):
+            st = self._backing.stat(cue_file)
+        signature = (st.st_mtime_ns, st.st_size)
+        try:
+            cached_signature, parsed = self._cue_cache.get(
+                cue_file, validate=lambda entry: entry[0] == signature)
+            return self._present_cue_files(cue_file, st, parsed)
+        except (AttributeError, NameError, TypeError, KeyError):
+            # Cue cache disabled, not yet cached, or the cue file changed.
+            pass
+        if(self._index is not None):
+            parsed = self._index.get(cue_file, self._format, st)
+            if(parsed is not None):
+                return self._store_cue_files(cue_file, st, parsed, indexed=True)
+        parsed = cue_tracks(cue_file, self._format, verbose=verbose,
+                            exists=self._backing.exists)
+        return self._store_cue_files(cue_file, st, parsed)
+
+    def _store_cue_files(self, cue_file, st, parsed, indexed=False):
+        """Store the results of cue_tracks in the cache, index, and manifest.
+
+        If indexed is True, the results came from the index and are not
+        stored there again.
+
+        Returns
+        -------
+        to_add, meta, to_remove
+            The results for the audio files that currently exist, as
+            returned by get_cue_files.
         """
-        unknown_tracks = 0
+        if(self._watcher is not None):
+            self._watcher.watch(os.path.dirname(cue_file))
         try:
-            if(cue_file in self._cue_cache):
-                return self._cue_cache[cue_file]
+            self._cue_cache[cue_file] = ((st.st_mtime_ns, st.st_size), parsed)
         except (AttributeError, NameError, TypeError):
-            # Cue cache disabled.
+            # Not using caching.
             pass
-        info = read_cue(cue_file, verbose=verbose)
-        to_remove = []
-        to_add = {}
-        meta = {}
-        # Get all files mentioned in the Cue sheet.
-        cuefiles = info['Files']
-        # Get the album information.
-        try:
-            album = info['TITLE']
-        except KeyError:
-            album = 'Unknown'
+        if(self._index is not None and not indexed):
+            self._index.put(cue_file, self._format, st, parsed)
+        return self._present_cue_files(cue_file, st, parsed)
+
+    def _present_cue_files(self, cue_file, st, parsed):
+        """Filter the results of cue_tracks to the audio files that exist.
+
+        The manifest entry for the cue file is updated to match.
+
+        Returns
+        -------
+        to_add, meta, to_remove
+            The results for the audio files that currently exist, as
+            returned by get_cue_files.
+        """
+        if(self._manifest_dir is None):
+            return present_tracks(cue_file, parsed, self._backing.exists)
+        # Stat the folder first so audio files added while checking
+        # leave the manifest entry out of date rather than wrong.
+        folder_st = self._backing.stat(os.path.dirname(cue_file))
+        present = present_tracks(cue_file, parsed, self._backing.exists)
         try:
-            album_artist = info['PERFORMER']
-        except KeyError:
-            album_artist = ''
-        if(album_artist == ''):
-            # No listed album artist. Use the artist from the first
-            # track of the first file.
+            self._write_manifest(cue_file, st, present, folder_st)
+        except Exception:
+            print(f'Error writing the manifest for {cue_file}:', file=sys.stderr, flush=True)
+            import traceback
+            traceback.print_exc()
+        return present
+
+    def _write_manifest(self, cue_file, st, parsed, folder_st):
+        """Add the parsed cue file to the manifest for its directory."""
+        signature = (st.st_mtime_ns, st.st_size, folder_st.st_mtime_ns)
+        directory, name = os.path.split(cue_file)
+        filename = manifest_path(self._manifest_dir, directory)
+        with self._manifest_lock:
             try:
-                first_file = list(cuefiles.keys())[0]
-                album_artist = cuefiles[first_file]['Tracks'][1]['PERFORMER']
+                self._manifests_written.get(cue_file, validate=lambda entry: entry == signature)
+                return
             except KeyError:
-                album_artist = 'Unknown'
-        for file in cuefiles:
-            # Get the full file path.
-            full_file = os.path.join(os.path.dirname(cue_file), file)
-            if(not os.path.exists(full_file)):
-                continue
+                # Not yet written, or written for an older signature.
+                pass
+            try:
+                with open(filename, 'r', encoding='utf_8') as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = {'cues': {}}
+            entry = manifest_entry(st, parsed, folder_st)
+            if(manifest['cues'].get(name) != entry):
+                manifest['cues'][name] = entry
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                # Write to a temporary file first so the scanner never
+                # sees a partially written manifest.
+                temp = f'{filename}.{os.getpid()}.tmp'
+                with open(temp, 'w', encoding='utf_8') as f:
+                    json.dump(manifest, f, ensure_ascii=False)
+                os.replace(temp, filename)
+            self._manifests_written[cue_file] = signature
 
-            # My cue files include "Disc 1", "Disc 2", and similar as the
-            # final part of the title for multi-disk sets. Something like:
-            # "Artist - Album Title Disc 3.cue"
-            # The scanner is designed to pull disc information from this
-            # and to group albums together.
+    def invalidate(self, directory, name=None):
+        """Drop cached entries affected by a change in a directory.
 
-            # Get the name of the cue file without the extension.
-            # Split it for white space.
-            try:
-                file_details = os.path.splitext(file)[-2].split()
-                # Check for disc numbering.
-                if(file_details[-2] == 'Disc'):
-                    disc = int(file_details[-1])
-                else:
-                    disc = 1
-            except IndexError:
-                disc = ''
-
-            # Split into tracks.
-            track_info = cuefiles[file]['Tracks']
-            start_time = '00:00:00'
-            end_time = '00:00:00'
-            # Handle each track.
-            for track in track_info:
-                try:
-                    title = track_info[track]['TITLE']
-                except KeyError:
-                    unknown_tracks += 1
-                    title = f'Unknown {unknown_tracks}'
-                try:
-                    artist = track_info[track]['PERFORMER']
-                except KeyError:
-                    # No track artist specified. Use the album artist.
-                    artist = album_artist
-                try:
-                    # Get the start time of the track.
-                    start_time = track_info[track]['INDEX'][1]
-                except KeyError:
-                    # If none is listed, use the previous end time.
-                    start_time = end_time
-                try:
-                    # Get the start time of the following track.
-                    # Use this as the end time for the current track.
-                    end_time = track_info[track+1]['INDEX'][1]
-                except (IndexError, KeyError):
-                    # For the last track, we specify -1 to indicate the end of file.
-                    end_time = '-1'
-                track_file = f'{artist} - {album} - {disc}{track:02d} {title}.{self._format}'
-                track_file = track_file.replace('/', ' ')
-                to_add[track_file] = full_file + f'.flaccuesplit.{start_time}.{end_time}.{self._format}'
-                # A bit of a hack needed for ffmpeg interfacing.
-                meta[track_file] = {'metadata:g:1': f'artist={artist}',
-                                    'metadata:g:2': f'album={album}',
-                                    'metadata:g:3': f'disc={disc}',
-                                    'metadata:g:4': f'track={track}',
-                                    'metadata:g:5': f'title={title}',
-                                    }
-            # Remove the FLAC file from the list to parse.
-            to_remove.append(file)
-        try:
-            self._cue_cache[cue_file] = (to_add, meta, to_remove)
+        Parameters
+        ----------
+        directory : str
+            The directory on the mirrored filesystem that changed.
+        name : str or None (optional)
+            The file in the directory that changed. Currently any
+            change drops every cached entry for the directory, as
+            audio files and cue files affect each other's entries.
+        """
+        if(self._verbose):
+            print(f'Change in {os.path.join(directory, name or "")}.', flush=True)
+        try:
+            self._cue_cache.discard_where(lambda key: os.path.dirname(key) == directory)
+            self._dir_index.pop(directory)
+            self._dir_stats.pop(directory)
+            self._negative_cache.discard_where(lambda key: os.path.dirname(key) == directory)
+            self._attr_cache.discard_where(lambda key: os.path.dirname(key) == directory)
+            self._nodes.discard_where(lambda key: os.path.dirname(key) == directory)
         except (AttributeError, NameError, TypeError):
-            # Not using caching.
+            # Not caching.
             pass
-        return to_add, meta, to_remove
+        self._backing.invalidate(directory)
+        if(self._index is not None):
+            self._index.discard(directory)
+
+    def init(self, path):
+        """Start the background indexer once the filesystem is mounted."""
+        if(self._preindex):
+            thread = threading.Thread(target=self.build_index, args=(self._preindex,), daemon=True)
+            thread.start()
+
+    def build_index(self, paths):
+        """Parse all cue files under the given paths in a process pool.
+
+        The results fill the cue cache and the persistent index. This
+        runs alongside normal filesystem requests.
+
+        Parameters
+        ----------
+        paths : list of str
+            The directories on the mirrored filesystem to search.
+        """
+        start = time.time()
+        parsed_count = 0
+        # Use fresh interpreters for the workers. Forking a process with
+        # running FUSE threads is not safe.
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._preindex_workers,
+                                                    mp_context=context,
+                                                    initializer=os.nice,
+                                                    initargs=(self._preindex_nice,)) as pool:
+            pending = {}
+            for path in paths:
+                for dirpath, dirnames, filenames in os.walk(self.clean_path(path)):
+                    for filename in filenames:
+                        if(os.path.splitext(filename)[1] != '.cue'):
+                            continue
+                        cue_file = os.path.join(dirpath, filename)
+                        try:
+                            st = self._backing.stat(cue_file)
+                        except OSError:
+                            continue
+                        if(self._index is not None):
+                            parsed = self._index.get(cue_file, self._format, st)
+                            if(parsed is not None):
+                                self._store_cue_files(cue_file, st, parsed, indexed=True)
+                                continue
+                        future = pool.submit(cue_tracks, cue_file, self._format)
+                        pending[future] = (cue_file, st)
+            for future in concurrent.futures.as_completed(pending):
+                cue_file, st = pending.pop(future)
+                try:
+                    self._store_cue_files(cue_file, st, future.result())
+                    parsed_count += 1
+                except Exception:
+                    print(f'Error parsing {cue_file}:', file=sys.stderr, flush=True)
+                    import traceback
+                    traceback.print_exc()
+        if(self._verbose):
+            print(f'Indexed {parsed_count} cue files in {time.time() - start:.1f} seconds.', flush=True)
+
+    def cache_stats(self):
+        """Get the counters for all of the caches."""
+        try:
+            stats = {'cue': self._cue_cache.stats(),
+                     'directory': self._dir_index.stats(),
+                     'directory stats': self._dir_stats.stats(),
+                     'negative': self._negative_cache.stats(),
+                     'attributes': self._attr_cache.stats(),
+                     'stream info': self._info_cache.stats(),
+                     'size': self._size_cache.stats(),
+                     'node': self._nodes.stats(),
+                     }
+        except (AttributeError, NameError, TypeError):
+            # Not caching.
+            stats = {}
+        stats.update(self._backing.stats())
+        if(self._window_cache is not None):
+            stats['window'] = self._window_cache.stats()
+        stats['decode'] = self._decoder.stats()
+        return stats
 
     def clean_path(self, path):
         """Get a file path for the FLAC file from a FLACCue path.
@@ -409,6 +2758,151 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
             path = os.path.join(self.root, os.path.splitdrive(path)[1][1:])
         return path
 
+    def directory_tracks(self, dir_path):
+        """Get the tracks created by all cue files in a directory.
+
+        Parameters
+        ----------
+        dir_path : str
+            The directory on the mirrored filesystem.
+
+        Returns
+        -------
+        tracks : dict
+            Dictionary of human friendly filename for tracks indexing
+            (split path, meta, cue filename) for the track.
+        """
+        return self._directory(dir_path)[0]
+
+    def directory_listing(self, dir_path):
+        """Get the directory contents with cue files expanded into tracks.
+
+        Parameters
+        ----------
+        dir_path : str
+            The directory on the mirrored filesystem.
+
+        Returns
+        -------
+        listing : list
+            The files in the directory other than cue files and the
+            files they reference, followed by the tracks from the
+            cue files.
+        """
+        return self._directory(dir_path)[1]
+
+    def directory_stats(self, dir_path):
+        """Get the stat results for the files in a directory.
+
+        The files are the ones kept with the tracks and listing. Files
+        can be rewritten without changing the directory, so the stat
+        results are only kept for attr_ttl seconds (or until the
+        watcher reports a change).
+
+        Parameters
+        ----------
+        dir_path : str
+            The directory on the mirrored filesystem.
+
+        Returns
+        -------
+        stats : dict
+            Dictionary of filename indexing the lstat result for each
+            file in the directory.
+        cue_stats : dict
+            Dictionary of cue file path indexing its stat result.
+        """
+        dir_path = os.path.normpath(dir_path)
+        files, cue_stats = self._directory(dir_path)[2:]
+        return self._file_stats(dir_path, files), cue_stats
+
+    def _file_stats(self, dir_path, files):
+        """Get the lstat results for the files from a directory entry."""
+        try:
+            # Entries from an older listing of the directory are out of date.
+            return self._dir_stats.get(dir_path, validate=lambda entry: entry[0] is files)[1]
+        except (AttributeError, NameError, TypeError, KeyError):
+            # Not caching, not yet cached, or out of date.
+            pass
+        stats = {}
+        for file in files:
+            try:
+                stats[file] = self._backing.lstat(os.path.join(dir_path, file))
+            except OSError:
+                pass
+        try:
+            self._dir_stats[dir_path] = (files, stats)
+        except (AttributeError, NameError, TypeError):
+            # Not caching.
+            pass
+        return stats
+
+    def _valid_directory(self, entry):
+        """Check whether a cached directory entry is still current."""
+        signatures = entry[0]
+        dir_path = next(iter(signatures))
+        if(self._watcher is not None and self._watcher.watching(dir_path)):
+            # Changes to the cue files are reported by the watcher, so
+            # only the directory itself needs checking.
+            return file_signature(dir_path, self._backing.stat) == signatures[dir_path]
+        return all(file_signature(source, self._backing.stat) == signature
+                   for source, signature in signatures.items())
+
+    def _directory(self, dir_path):
+        """Get the tracks, merged listing, files, and cue file stats for a directory.
+
+        The results are cached until the directory or any of its cue
+        files change. Finding a track by name then only needs a
+        dictionary lookup and listing the directory only a stat.
+        """
+        dir_path = os.path.normpath(dir_path)
+        try:
+            signatures, tracks, listing, files, cue_stats = self._dir_index.get(
+                dir_path, validate=self._valid_directory)
+            return tracks, listing, files, cue_stats
+        except (AttributeError, NameError, TypeError, KeyError):
+            # Not caching, not yet cached, or out of date.
+            pass
+        if(self._watcher is not None):
+            self._watcher.watch(dir_path)
+        # Get the signature before listing so changes during the listing
+        # invalidate the entry. The directory must be the first entry.
+        signatures = {dir_path: file_signature(dir_path, self._backing.stat)}
+        tracks = {}
+        referenced = set()
+        cue_stats = {}
+        files = self._backing.listdir(dir_path)
+        for cue_file in files:
+            if(os.path.splitext(cue_file)[1] != '.cue'):
+                continue
+            cue_path = os.path.join(dir_path, cue_file)
+            try:
+                # Stat the cue file once for its signature, parsing,
+                # and the times of its tracks.
+                cue_st = self._backing.stat(cue_path)
+                signatures[cue_path] = (cue_st.st_mtime_ns, cue_st.st_size)
+                cue_stats[cue_path] = cue_st
+                to_add, metadata, to_remove = self.get_cue_files(cue_path, verbose=self._verbose,
+                                                                 st=cue_st)
+            except Exception:
+                print(f'Error parsing {cue_file}:', file=sys.stderr, flush=True)
+                import traceback
+                traceback.print_exc()
+                continue
+            for track_file, split in to_add.items():
+                # The first cue file listing a track wins.
+                tracks.setdefault(track_file, (split, metadata[track_file], cue_path))
+            referenced.update(to_remove)
+        listing = [f for f in files
+                   if f not in referenced and os.path.splitext(f)[1] != '.cue']
+        listing.extend(tracks)
+        try:
+            self._dir_index[dir_path] = (signatures, tracks, listing, files, cue_stats)
+        except (AttributeError, NameError, TypeError):
+            # Not caching.
+            pass
+        return tracks, listing, files, cue_stats
+
     def find_cue_path(self, path, verbose=False):
         """Find the path necessary for extracting tracks using the cue sheets.
 
@@ -420,7 +2914,8 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
             search the cue files in the path directory for tracks matching
             the path.
         verbose : bool (optional)
-            If True, print any filename conversion details.
+            Unused. Conversions are printed by lookup when the
+            filesystem is verbose.
 
         Returns
         -------
@@ -430,37 +2925,254 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
             Metadata associated with the input path. Only provided
             when the path is created from a cue file.
         """
-        meta = {}
-        if('.flaccuesplit.' not in path and not os.path.exists(path)):
+        node = self.lookup(path)
+        if(node.is_track):
+            return node.split, node.meta
+        return path, {}
+
+    def _node_key(self, path):
+        """Get the key for a path in the node and attribute tables."""
+        key = os.path.normpath(self.clean_path(path))
+        if('.flaccuesplit.' in path):
+            # Keep the track details so the track isn't confused with
+            # its base file (or other tracks from it).
+            key = f'{key}.flaccuesplit.{path.split(".flaccuesplit.", 1)[1]}'
+        return key
+
+    def lookup(self, path):
+        """Resolve a path on the FLACCue filesystem to its node.
+
+        Tracks are kept in a table of nodes until their directory, cue
+        file, or base file changes (as reported by the watcher if
+        active, or by their modification times), so later operations
+        on the same path skip matching it against the cue files.
+
+        Parameters
+        ----------
+        path : str
+            The path on the FLACCue filesystem. If the file exists or
+            already includes the flaccuesplit details, it is used
+            directly. Otherwise, the cue files in its directory are
+            searched for a matching track.
+
+        Returns
+        -------
+        node : Node
+            The node for the path. Paths that are not tracks are
+            passed through as nodes for the real file.
+        """
+        key = self._node_key(path)
+        try:
+            return self._nodes.get(key, validate=self._valid_node)
+        except (AttributeError, NameError, TypeError, KeyError):
+            # Not caching, not yet cached, or out of date.
+            pass
+        dir_path = os.path.dirname(key)
+        # Signatures first, so changes while resolving invalidate the node.
+        signatures = {dir_path: file_signature(dir_path, self._backing.stat)}
+        if('.flaccuesplit.' in path):
+            # Already a split path, as used by the scanner.
+            split, meta, cue_file = path, {}, None
+        else:
+            if(self._backing.exists(key)):
+                return Node(key)
             try:
-                path, meta = self._track_cache[path]
+                # Recently looked up with no matching track.
+                self._negative_cache.get(key)
+                return Node(key)
             except (AttributeError, NameError, TypeError, KeyError):
-                # Not caching or not yet cached.
-                raw_path = path
-                dir_path = self.clean_path(os.path.dirname(path))
-                files = os.listdir(dir_path)
-                for cue_file in files:
-                    if(os.path.splitext(cue_file)[1] == '.cue'):
-                        try:
-                            # Don't use verbose here. Overly spammy.
-                            to_add, metadata, to_remove = self.get_cue_files(os.path.join(dir_path, cue_file))
-                            base_path = os.path.basename(path)
-                            if(base_path in to_add):
-                                path = to_add[base_path]
-                                meta = metadata[base_path]
-                                break
-                        except Exception:
-                            print(f'Error parsing {cue_file}:', file=sys.stderr, flush=True)
-                            import traceback
-                            traceback.print_exc()
+                pass
+            try:
+                split, meta, cue_file = self.directory_tracks(dir_path)[os.path.basename(key)]
+            except KeyError:
+                # No cue file has this track. Remember that for a
+                # while, but not in the node table so that probes
+                # for files like .DS_Store can't push out real tracks.
+                try:
+                    self._negative_cache[key] = True
+                except (AttributeError, NameError, TypeError):
+                    # Not caching.
+                    pass
+                return Node(key)
+            signatures[cue_file] = file_signature(cue_file, self._backing.stat)
+            if(self._verbose):
+                print(f'{path} -> {split}', flush=True)
+        node = Node(key, split, meta, cue_file, signatures)
+        # The attributes kept with the node depend on the base file.
+        source = self.clean_path(node.source)
+        signatures[source] = file_signature(source, self._backing.stat)
+        try:
+            self._nodes[key] = node
+        except (AttributeError, NameError, TypeError):
+            # Not caching.
+            pass
+        return node
+
+    def _node_info(self, node, st=None):
+        """Get the stream info for the base file of a track node.
+
+        The info is kept with the node.
+        """
+        if(node.info is None):
+            node.info = self.stream_info(self.clean_path(node.source), st)
+        return node.info
+
+    def _valid_node(self, node):
+        """Check whether a node from the table is still current.
+
+        Changes to watched directories and the files in them are
+        reported by the watcher. The rest are checked against their
+        signatures.
+        """
+        watcher = self._watcher
+        return all(file_signature(path, self._backing.stat) == signature
+                   for path, signature in node.signatures.items()
+                   if watcher is None or not (watcher.watching(path) or
+                                              watcher.watching(os.path.dirname(path))))
+
+    def _file_attrs(self, st):
+        """Get the attribute dictionary for a stat result."""
+        toreturn = dict((key, getattr(st, key)) for key in (
+            'st_atime', 'st_ctime', 'st_gid', 'st_ino', 'st_mode', 'st_mtime',
+            'st_nlink', 'st_size', 'st_uid'))
+        # Ensure the mode shows the file as readable.
+        toreturn['st_mode'] = toreturn['st_mode'] | 0o444
+        toreturn['st_ino'] = file_inode(st, self._root_dev)
+        return toreturn
+
+    def stream_info(self, path, st=None):
+        """Get the stream info for an audio file.
+
+        The info is cached by device, inode, and modification time, so
+        repeated calls only need the stat result.
+
+        Parameters
+        ----------
+        path : str
+            The audio file on the mirrored filesystem.
+        st : os.stat_result (optional)
+            The stat result for the file if already known.
+
+        Returns
+        -------
+        info : StreamInfo
+            The stream details for the file.
+        """
+        if(st is None):
+            st = self._backing.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        try:
+            return self._info_cache.get(key)
+        except (AttributeError, NameError, TypeError, KeyError):
+            # Not caching or not yet cached.
+            pass
+        info = StreamInfo.from_file(path)
+        try:
+            self._info_cache[key] = info
+        except (AttributeError, NameError, TypeError):
+            # Not caching.
+            pass
+        return info
+
+    def _track_size(self, size_key, source, times, meta, st):
+        """Get the size of an extracted track.
+
+        WAV sizes are exact. For other formats, the size recorded after
+        the track was first extracted is used when available. Otherwise
+        the size of the raw audio is used as an estimate.
+
+        Parameters
+        ----------
+        size_key : str
+            The track filename on the FLACCue filesystem.
+        source : str
+            The base audio file.
+        times : str
+            The "{start_time}.{end_time}" portion of the split path.
+        meta : TrackMeta or dict
+            The metadata for the track.
+        st : os.stat_result
+            The stat result for the base audio file.
+        """
+        info = self.stream_info(source, st)
+        start, end = split_samples(times, info)
+        if(self._format == 'wav'):
+            fmt, codec, width = pcm_format(info.bits_per_sample)
+            return len(wav_header(info, end - start, meta)) + (end - start)*info.channels*width
+        signature = (st.st_mtime_ns, st.st_size)
+        try:
+            return self._size_cache.get(size_key, validate=lambda entry: entry[0] == signature)[1]
+        except (AttributeError, NameError, TypeError, KeyError):
+            # Not caching, not yet cached, or out of date.
+            pass
+        if(self._index is not None):
+            size = self._index.get_size(size_key, self._format, st)
+            if(size is not None):
                 try:
-                    self._track_cache[raw_path] = (path, meta)
+                    self._size_cache[size_key] = (signature, size)
                 except (AttributeError, NameError, TypeError):
                     # Not caching.
                     pass
-                if(verbose):
-                    print(f'{raw_path} -> {path}', flush=True)
-        return path, meta
+                return size
+        # Estimate the file size.
+        return int((end - start)*info.channels*(info.bits_per_sample/8))
+
+    def _record_size(self, size_key, st, size):
+        """Record the size of an extracted track in a compressed format."""
+        try:
+            self._size_cache[size_key] = ((st.st_mtime_ns, st.st_size), size)
+            # Drop any attributes still holding the estimate.
+            self._attr_cache.pop(size_key)
+            node = self._nodes.pop(size_key)
+            if(node is not None):
+                node.attrs = None
+        except (AttributeError, NameError, TypeError):
+            # Not caching.
+            pass
+        if(self._index is not None):
+            self._index.put_size(size_key, self._format, st, size)
+
+    def _track_attrs(self, path, size_key, meta, st=None, cue_file=None, cue_st=None):
+        """Get the attribute dictionary for a FLACCue split path.
+
+        The inode number is derived from the base file and track times.
+        The change and modification times are the later of the base
+        file's and the cue file's, as the track changes with either.
+
+        Parameters
+        ----------
+        path : str
+            The path including the flaccuesplit details.
+        size_key : str
+            The track filename on the FLACCue filesystem.
+        meta : TrackMeta or dict
+            The metadata for the track.
+        st : os.stat_result (optional)
+            The stat result for the base file if already known.
+        cue_file : str (optional)
+            The cue file the track is from. If not provided, it is
+            looked up from size_key.
+        cue_st : os.stat_result (optional)
+            The stat result for the cue file if already known.
+        """
+        path, flaccue_details = path.split('.flaccuesplit.')
+        path = self.clean_path(path)
+        times, extension = os.path.splitext(flaccue_details)
+        # Get the info for the base file.
+        if(st is None):
+            st = self._backing.lstat(path)
+        toreturn = self._file_attrs(st)
+        toreturn['st_size'] = self._track_size(size_key, path, times, meta, st)
+        toreturn['st_ino'] = track_inode(st, times, os.path.basename(size_key))
+        if(cue_file is None):
+            track = self.directory_tracks(os.path.dirname(size_key)).get(os.path.basename(size_key))
+            cue_file = track[2] if track is not None else None
+        if(cue_file is not None):
+            if(cue_st is None):
+                cue_st = self._backing.stat(cue_file)
+            toreturn['st_mtime'] = max(st.st_mtime, cue_st.st_mtime)
+            toreturn['st_ctime'] = max(st.st_ctime, cue_st.st_ctime)
+        return toreturn
 
     def getattr(self, path, *args, **pargs):
         """Get the attributes of the file path.
@@ -468,71 +3180,80 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
         If it's one of the FLACCue paths, we need to adjust the file size to be
         appropriate for the shortened data.
         """
-        path, meta = self.find_cue_path(path)
-        if('.flaccuesplit.' in path):
+        try:
+            # Filled in by a recent readdir.
+            return self._attr_cache.get(self._node_key(path))
+        except (AttributeError, NameError, TypeError, KeyError):
+            pass
+        node = self.lookup(path)
+        if(node.is_track):
+            if(node.attrs is not None):
+                return node.attrs
             try:
-                raw_path = path
-                path, flaccue_details = path.split('.flaccuesplit.')
-                path = self.clean_path(path)
-                times, extension = os.path.splitext(flaccue_details)
-                # Get the info for the base file.
-                st = os.lstat(path)
-                toreturn = dict((key, getattr(st, key)) for key in (
-                                'st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
-                                'st_nlink', 'st_size', 'st_uid'))
-                # Estimate the file size.
-                f = mutagen.File(path)
-                start, end = times.split('.')
-                # Minutes:Seconds:Frames
-                # 75 frames per second.
-                start_split = [int(x) for x in start.split(':')]
-                if(len(start_split) != 3):
-                    start_time = 0
-                else:
-                    start_time = start_split[0]*60 + start_split[1] + start_split[2]/75
-                end_split = [int(x) for x in end.split(':')]
-                if(len(end_split) != 3):
-                    end_time = f.info.length
-                else:
-                    end_time = end_split[0]*60 + end_split[1] + end_split[2]/75
-                toreturn['st_size'] = int((end_time - start_time) *
-                                          f.info.channels *
-                                          (f.info.bits_per_sample/8) *
-                                          f.info.sample_rate)
-                # Ensure the mode shows the file as readable.
-                toreturn['st_mode'] = toreturn['st_mode'] | 0o444
-                return toreturn
+                node.attrs = self._track_attrs(node.split, node.path, node.meta,
+                                               cue_file=node.cue_file)
+                return node.attrs
             except Exception:
-                print(f'Error getting attributes for {raw_path}:', file=sys.stderr, flush=True)
+                print(f'Error getting attributes for {node.split}:', file=sys.stderr, flush=True)
                 import traceback
                 traceback.print_exc()
-        # Otherwise, just get the normal info.
-        path = self.clean_path(path)
-        st = os.lstat(path)
-        toreturn = dict((key, getattr(st, key)) for key in (
-            'st_atime', 'st_ctime', 'st_gid', 'st_mode', 'st_mtime',
-            'st_nlink', 'st_size', 'st_uid'))
-        # Ensure the mode shows the file as readable.
-        toreturn['st_mode'] = toreturn['st_mode'] | 0o444
-        return toreturn
+            # Otherwise, just get the normal info.
+            return self._file_attrs(self._backing.lstat(self.clean_path(node.source)))
+        return self._file_attrs(self._backing.lstat(node.path))
 
     def open(self, path, flags, *args, **pargs):
-        """Open the specified path."""
+        """Open the specified path.
+
+        When mounted with raw_fi=True, flags is the fuse_file_info
+        structure. The file handle is stored in it and split tracks
+        are opened with keep_cache set.
+        """
+        if(isinstance(flags, int)):
+            return self._open(path, flags, *args, **pargs)
+        fi = flags
+        fi.fh = self._open(path, fi.flags)
+        # Split tracks only change with their base file and cue file, so
+        # the kernel can keep them cached. Nothing drops the cached pages
+        # when those change, so they are only kept while the track is
+        # unchanged since it was cached. Other files are passed through
+        # as is.
+        fi.keep_cache = int(self._keep_cache and path in self._open_subtracks and
+                            self._cached_track_current(path))
+        return 0
+
+    def _cached_track_current(self, path):
+        """Check whether a track is unchanged since the kernel may have cached it.
+
+        The signatures of the base file and cue file are recorded for
+        the next open.
+        """
+        node = self.lookup(path)
+        signature = (file_signature(self.clean_path(node.source), self._backing.stat),
+                     file_signature(node.cue_file, self._backing.stat)
+                     if node.cue_file is not None else None)
+        try:
+            current = self._page_signatures.get(path) == signature
+        except KeyError:
+            current = False
+        self._page_signatures[path] = signature
+        return current
+
+    def _open(self, path, flags, *args, **pargs):
+        """Open the specified path and return the file handle."""
         # We don't want FLACCue messing with actual data.
         # Only allow Read-Only access.
         if((flags | os.O_RDONLY) == 0):
             raise ValueError('Can only open files read-only.')
         raw_path = path
-        path, meta = self.find_cue_path(path, verbose=self._verbose)
+        node = self.lookup(path)
         # Handle the FLACCue files.
-        if('.flaccuesplit.' in path):
+        if(node.is_track):
             # Get a path to the actual file name.
             # Note that files accessed through FLACCue will
             # still read normally--we just need to trim off the song
             # times and fix the file extension.
-            path, flaccue_details = path.split('.flaccuesplit.')
-            path = self.clean_path(path)
-            times, extension = os.path.splitext(flaccue_details)
+            path = self.clean_path(node.source)
+            times, meta = node.times, node.meta
 
             # Now get the start and end times.
             start, end = times.split('.')
@@ -551,36 +3272,59 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
             else:
                 end_time = end_split[0]*60 + end_split[1] + end_split[2]/75
 
+            size_key = node.path
+
             # Hold a file handle for the actual file.
             fd = os.open(path, flags, *args, **pargs)
-            with self.rwlock:
-                # If we've already processed this file and still have it in memory.
-                if(raw_path in self._open_subtracks):
-                    if(self._open_subtracks[raw_path]['Audio'] is not None):
-                        # Update the stored info.
-                        self._open_subtracks[raw_path]['Last Access'] = time.time()
-                        self._open_subtracks[raw_path]['Positions'][fd] = 0
-                        # Return the file handle.
-                        return fd
-                    else:
-                        # We're still processing this track. Wait for it to finish.
-                        process = False
-                        self._open_subtracks[raw_path]['Positions'][fd] = 0
-                else:
-                    # This is a new track to process.
-                    process = True
-                    self._open_subtracks[raw_path] = {'Positions': {fd: 0},
-                                                      'Last Access': time.time(),
-                                                      'Audio': None,
-                                                      }
-            if(process):
-                def load():
-                    if(self._verbose):
-                        print(f'Loading {raw_path}...', flush=True)
+            if(self._window_cache is not None and self._format == 'wav'):
+                # Decode only the parts of the track that are read.
+                try:
+                    st = os.fstat(fd)
+                    info = self._node_info(node, st)
+                    start, end = split_samples(times, info)
+                    audio = WindowedTrack(path, st, info, start, end, meta,
+                                          int(self._window_seconds*info.sample_rate),
+                                          self._window_cache)
+                except Exception:
+                    os.close(fd)
+                    raise
+            else:
+                # Reads are served from the buffer as the track is extracted.
+                audio = TrackBuffer()
+            def load():
+                if(self._verbose):
+                    print(f'Loading {raw_path}...', flush=True)
+                try:
                     # Otherwise, we have to process the FLAC file to extract the track.
-                    # Open the file with FFMPEG.
-                    track = ffmpeg.input(path)
-                    if(self._use_tempfile):
+                    # Open the file with FFMPEG. Seek on the input to the whole second
+                    # before the track so ffmpeg skips straight there instead of decoding
+                    # everything before it. The rest is trimmed relative to that point.
+                    seek = int(start_time)
+                    track = ffmpeg.input(path, ss=seek) if seek else ffmpeg.input(path)
+                    trim_start, trim_end = start_time - seek, end_time - seek
+                    if(self._format == 'wav'):
+                        # Write the header ourselves and have ffmpeg output just the
+                        # samples of the track so the size matches getattr exactly.
+                        info = self._node_info(node)
+                        start, end = split_samples(times, info)
+                        fmt, codec, width = pcm_format(info.bits_per_sample)
+                        offset = seek*info.sample_rate
+                        output = track.audio.filter('atrim', start_sample=start - offset,
+                                                    end_sample=end - offset)
+                        output = output.output('pipe:', format=fmt, acodec=codec)
+                        audio.append(wav_header(info, end - start, meta))
+                        # Stream the samples in as they are decoded.
+                        size = (end - start)*info.channels*width
+                        pcm_size = self._stream(output, audio, limit=size)
+                        if(pcm_size < size):
+                            audio.append(bytes(size - pcm_size))
+                    elif(self._split_frames and self._format == 'flac' and
+                         StreamInfo.from_flac(path) is not None):
+                        # Copy the encoded frames of the track from the FLAC file.
+                        info = self._node_info(node)
+                        start, end = split_samples(times, info)
+                        audio.append(split_flac(path, info, start, end, meta))
+                    elif(self._use_tempfile):
                         # Use a tempfile so ffmpeg can update metadata after finishing
                         # compression.
                         with tempfile.TemporaryDirectory() as temp:
@@ -588,66 +3332,65 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
                             # Set the output to convert to a temporary file.
                             # Trim it to start at start_time and end at end_time.
                             try:
-                                output = track.output(filename, ss=start_time, to=end_time,
+                                output = track.output(filename, ss=trim_start, to=trim_end,
                                                       format=self._format, compression_level=0,
                                                       **meta)
                             except TypeError:
                                 # compression_level not supported for the format?
-                                output = track.output(filename, ss=start_time, to=end_time,
+                                output = track.output(filename, ss=trim_start, to=trim_end,
                                                       format=self._format, **meta)
                             # Do the conversion.
                             output.run()
                             # Read the temporary file in as a bytes buffer.
                             with open(filename, 'rb') as f:
-                                data = f.read()
+                                audio.append(f.read())
                     else:
                         # Set the output to convert to a wave file and pipe to stdout.
                         # Trim it to start at start_time and end at end_time.
                         try:
-                            output = track.output('pipe:', ss=start_time, to=end_time,
+                            output = track.output('pipe:', ss=trim_start, to=trim_end,
                                                   format=self._format, compression_level=0,
                                                   **meta)
                         except TypeError:
                             # compression_level not supported for the format?
-                            output = track.output('pipe:', ss=start_time, to=end_time,
+                            output = track.output('pipe:', ss=trim_start, to=trim_end,
                                                   format=self._format, **meta)
-                        # Do the conversion. Capture stdout into a buffer.
-                        data, _ = output.run(capture_stdout=True)
-                        # Convert the buffer to a numpy array. Use bytes to access just like a
-                        # normal file.
-                    # Convert the buffer to a numpy array. Use bytes to access just like a
-                    # normal file.
-                    audio = numpy.frombuffer(data, dtype=numpy.uint8)
-
-                    with(self.rwlock):
-                        # Keep a copy of the data in memory.
-                        self._open_subtracks[raw_path]['Last Access'] = time.time()
-                        self._open_subtracks[raw_path]['Audio'] = audio
-
-                    # Define a function that will clean up the memory use once it hasn't been
-                    # used for a while.
-                    def cleanup():
-                        # Wait until there has been no access to the data for 60 seconds.
-                        while(True):
-                            with(self.rwlock):
-                                # Do this all within the same lock to avoid potential changes
-                                # in between the check and deletion.
-                                if(time.time() - self._open_subtracks[raw_path]['Last Access'] > 60 and
-                                   len(self._open_subtracks[raw_path]['Positions']) == 0):
-                                    del self._open_subtracks[raw_path]
-                                    break
-                            # Check every 5 seconds.
-                            time.sleep(5)
-                        if(self._verbose):
-                            print(f'{raw_path} closed.', flush=True)
-
-                    # Start a thread running that function.
-                    thread = threading.Thread(target=cleanup)
-                    thread.start()
-
-                # Start a thread running that function.
-                thread = threading.Thread(target=load)
-                thread.start()
+                        # Stream the output in as it is encoded.
+                        self._stream(output, audio)
+                    if(self._format != 'wav'):
+                        # Compressed sizes are only known after encoding. Record the
+                        # size so getattr reports it from now on.
+                        self._record_size(size_key, self._backing.stat(path), len(audio))
+                    audio.finish()
+                except Exception as e:
+                    print(f'Error extracting {raw_path}:', file=sys.stderr, flush=True)
+                    import traceback
+                    traceback.print_exc()
+                    audio.finish(e)
+
+                with(self.rwlock):
+                    self._open_subtracks[raw_path]['Last Access'] = time.time()
+
+            with self.rwlock:
+                # If we've already processed this file (or are processing it) and still
+                # have it in memory.
+                if(raw_path in self._open_subtracks):
+                    # Update the stored info.
+                    self._open_subtracks[raw_path]['Last Access'] = time.time()
+                    self._open_subtracks[raw_path]['Positions'][fd] = 0
+                    # Return the file handle.
+                    return fd
+                # This is a new track to process. The extraction is queued by
+                # the first read that reaches FLACCue, as the kernel may still
+                # have the whole track cached. WindowedTrack has nothing to
+                # extract up front.
+                self._open_subtracks[raw_path] = {'Positions': {fd: 0},
+                                                  'Last Access': time.time(),
+                                                  'Audio': audio,
+                                                  'Load': None if isinstance(audio, WindowedTrack) else load,
+                                                  }
+            # Clean up the memory use once it hasn't been used for a while.
+            self._cleanup(raw_path)
             # Return the file handle.
             return fd
         else:
@@ -655,65 +3398,168 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
             # This allows FLAC files to be read with a FLACCue path.
             # Note that you do not want to run this as root as this will
             # give anyone read access to any file.
-            return os.open(path, flags, *args, **pargs)
+            return os.open(node.path, flags, *args, **pargs)
+
+    def _request_priority(self):
+        """Get the DecodeQueue priority for the process making the current request."""
+        try:
+            uid, gid, pid = fuse.fuse_get_context()
+        except (AttributeError, ValueError):
+            # Not called from FUSE.
+            return DecodeQueue.INTERACTIVE
+        try:
+            # The pid is the thread. Name the process it belongs to.
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if(line.startswith('Tgid:')):
+                        pid = int(line.split()[1])
+                        break
+            with open(f'/proc/{pid}/comm') as f:
+                name = f.read().strip()
+        except (OSError, ValueError):
+            return DecodeQueue.INTERACTIVE
+        if(name.startswith(self._bulk_processes)):
+            return DecodeQueue.BULK
+        return DecodeQueue.INTERACTIVE
+
+    def _cleanup(self, raw_path):
+        """Start a thread to drop an open track once it is no longer used."""
+        def cleanup():
+            # Wait until there has been no access to the data for 60 seconds.
+            while(True):
+                with(self.rwlock):
+                    # Do this all within the same lock to avoid potential changes
+                    # in between the check and deletion.
+                    entry = self._open_subtracks[raw_path]
+                    # Keep tracks that are queued or being extracted.
+                    extracting = (isinstance(entry['Audio'], TrackBuffer) and
+                                  entry['Load'] is None and not entry['Audio'].complete)
+                    if(time.time() - entry['Last Access'] > 60 and
+                       len(entry['Positions']) == 0 and not extracting):
+                        del self._open_subtracks[raw_path]
+                        break
+                # Check every 5 seconds.
+                time.sleep(5)
+            if(self._verbose):
+                print(f'{raw_path} closed.', flush=True)
+
+        # Start a thread running that function.
+        thread = threading.Thread(target=cleanup)
+        thread.start()
+
+    def _stream(self, output, audio, limit=None):
+        """Run an ffmpeg output to stdout, appending to a TrackBuffer as it runs.
+
+        Parameters
+        ----------
+        output : ffmpeg.nodes.OutputStream
+            The ffmpeg output, writing to 'pipe:'.
+        audio : TrackBuffer
+            The buffer to append the output to.
+        limit : int or None (optional)
+            If provided, the maximum number of bytes to append. Any
+            further output is discarded.
+
+        Returns
+        -------
+        size : int
+            The number of bytes appended.
+        """
+        process = output.run_async(pipe_stdout=True)
+        size = 0
+        try:
+            while(True):
+                chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+                if(not chunk):
+                    break
+                if(limit is not None):
+                    # Keep reading so ffmpeg can finish, but drop the excess.
+                    chunk = chunk[:limit - size]
+                if(chunk):
+                    audio.append(chunk)
+                    size += len(chunk)
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if(returncode != 0):
+            raise ffmpeg.Error('ffmpeg', None, None)
+        return size
 
     def read(self, path, size, offset, fh, *args, **pargs):
         """Read data from the path."""
+        # Get the file handle from the fuse_file_info with raw_fi.
+        fh = getattr(fh, 'fh', fh)
         with self.rwlock:
             if(path in self._open_subtracks):
-                real = False
                 # Update the last accessed time.
                 self._open_subtracks[path]['Last Access'] = time.time()
                 # Store the requested offset.
                 self._open_subtracks[path]['Positions'][fh] = offset
+                audio = self._open_subtracks[path]['Audio']
+                # Only the first read queues the extraction.
+                load = self._open_subtracks[path]['Load']
+                self._open_subtracks[path]['Load'] = None
             else:
-                real = True
-        if(real):
+                audio = None
+        if(audio is None):
             # For all non-FLACCue files, just access it normally.
             os.lseek(fh, offset, 0)
             return os.read(fh, size)
-        # Wait for the file to finish opening.
-        while(True):
-            with(self.rwlock):
-                self._open_subtracks[path]['Last Access'] = time.time()
-                if(self._open_subtracks[path]['Audio'] is not None):
-                    audio = self._open_subtracks[path]['Audio']
-                    break
-            time.sleep(0.1)
-        # Return the data requested.
+        if(load is not None):
+            # Queue the extraction, behind any playback if this is a library scan.
+            self._decoder.submit(audio, load, self._request_priority())
+        if(isinstance(audio, TrackBuffer) and not audio.complete and self._decoder.pending(audio)):
+            # Someone is waiting on this track now. Move it up if they aren't a scan.
+            self._decoder.bump(audio, self._request_priority())
+        # Return the data requested as soon as it has been extracted.
+        data = audio.read(offset, size)
         if(offset > len(audio)):
             # If we're looking near the end of the file,
             # handle the fact that compression could change the size.
             reported_size = self.getattr(path)['st_size']
             if(offset < reported_size):
                 offset = len(audio) - (reported_size - offset)
-        return audio[offset:offset+size].tobytes()
+                data = audio.read(offset, size)
+        return data
 
     def readdir(self, path, fh, *args, **pargs):
-        """Read the contents of the directory."""
-        path = self.clean_path(path)
-        files = os.listdir(path)
-        i = 0
-        while(i < len(files)):
-            if(os.path.splitext(files[i])[1] == '.cue'):
-                cue_file = files.pop(i)
-                try:
-                    to_add, meta, to_remove = self.get_cue_files(
-                        os.path.join(path, cue_file), verbose=self._verbose)
-                    files.extend(to_add.keys())
-                    for f in to_remove:
-                        files.remove(f)
-                except Exception:
-                    print(f'Error parsing {cue_file}:', file=sys.stderr, flush=True)
-                    import traceback
-                    traceback.print_exc()
-            else:
-                i += 1
+        """Read the contents of the directory.
 
-        return ['.', '..'] + files
+        Each entry is returned with its attributes, computed together for
+        the whole directory from the stat results for the directory
+        (the stream info for each base file is only read once). The
+        attributes are also kept briefly so the getattr calls that
+        usually follow a listing are answered from memory.
+        """
+        dir_path = os.path.normpath(self.clean_path(path))
+        tracks, listing, files, cue_stats = self._directory(dir_path)
+        stats = self._file_stats(dir_path, files)
+        files = [('.', None, 0), ('..', None, 0)]
+        for name in listing:
+            try:
+                if(name in stats):
+                    attrs = self._file_attrs(stats[name])
+                else:
+                    split, meta, cue_file = tracks[name]
+                    source = self.clean_path(split)
+                    st = stats.get(os.path.basename(source)) if os.path.dirname(source) == dir_path else None
+                    attrs = self._track_attrs(split, os.path.join(dir_path, name), meta, st=st,
+                                              cue_file=cue_file, cue_st=cue_stats.get(cue_file))
+            except Exception:
+                # Leave it to getattr (and its error reporting).
+                attrs = None
+            if(attrs is not None):
+                try:
+                    self._attr_cache[os.path.join(dir_path, name)] = attrs
+                except (AttributeError, NameError, TypeError):
+                    # Not caching.
+                    pass
+            files.append((name, attrs, 0))
+        return files
 
     def release(self, path, fh, *args, **pargs):
         """Release the file handle."""
+        fh = getattr(fh, 'fh', fh)
         with(self.rwlock):
             # If we're closing a FLACCue file...
             if(path in self._open_subtracks):
@@ -726,7 +3572,7 @@ class FLACCue(fuse.LoggingMixIn, fuse.Operations):
         """Get the dictionary of filesystem stats."""
         path, meta = self.find_cue_path(path)
         path = self.clean_path(path)
-        stv = os.statvfs(path)
+        stv = self._backing.statvfs(path)
         return dict((key, getattr(stv, key)) for key in (
             'f_bavail', 'f_bfree', 'f_blocks', 'f_bsize', 'f_favail',
             'f_ffree', 'f_files', 'f_flag', 'f_frsize', 'f_namemax'))
@@ -741,10 +3587,154 @@ if __name__ == '__main__':
                         dest='format', type=str,
                         default='wav',
                         help='The audio file format to use for the split files.')
+    parser.add_argument('--cue-cache-size',
+                        dest='cue_cache_size', type=int,
+                        default=10000,
+                        help='The maximum number of parsed cue files to keep in memory.')
+    parser.add_argument('--dir-cache-size',
+                        dest='dir_cache_size', type=int,
+                        default=20000,
+                        help='The maximum number of directory track listings to keep in memory.')
+    parser.add_argument('--negative-cache-size',
+                        dest='negative_cache_size', type=int,
+                        default=10000,
+                        help='The maximum number of missing paths to remember.')
+    parser.add_argument('--negative-ttl',
+                        dest='negative_ttl', type=float,
+                        default=30,
+                        help='How many seconds to remember missing paths for.')
+    parser.add_argument('--attr-cache-size',
+                        dest='attr_cache_size', type=int,
+                        default=10000,
+                        help='The maximum number of file attributes from listings to remember.')
+    parser.add_argument('--attr-ttl',
+                        dest='attr_ttl', type=float,
+                        default=5,
+                        help='How many seconds to use file attributes from listings for.')
+    parser.add_argument('--info-cache-size',
+                        dest='info_cache_size', type=int,
+                        default=10000,
+                        help='The maximum number of audio files to remember the stream info for.')
+    parser.add_argument('--size-cache-size',
+                        dest='size_cache_size', type=int,
+                        default=100000,
+                        help='The maximum number of compressed track sizes to remember.')
+    parser.add_argument('--node-cache-size',
+                        dest='node_cache_size', type=int,
+                        default=200000,
+                        help='The maximum number of resolved tracks to keep in memory.')
+    parser.add_argument('-i', '--index',
+                        dest='index', type=str,
+                        default=None,
+                        help='A file to store parsed cue files in across restarts.')
+    parser.add_argument('--preindex',
+                        dest='preindex', type=str, action='append',
+                        default=None,
+                        help='A directory to search for cue files to parse in the background '
+                             'once mounted. May be given more than once.')
+    parser.add_argument('--preindex-workers',
+                        dest='preindex_workers', type=int,
+                        default=None,
+                        help='The number of processes used for background parsing '
+                             '(default: one per CPU).')
+    parser.add_argument('--preindex-nice',
+                        dest='preindex_nice', type=int,
+                        default=10,
+                        help='The niceness of the background parsing processes.')
+    parser.add_argument('-w', '--watch',
+                        dest='watch', action='store_true',
+                        help='Watch directories with inotify to drop cached entries on changes.')
+    parser.add_argument('-m', '--manifest-dir',
+                        dest='manifest_dir', type=str,
+                        default=None,
+                        help='A directory to write track manifests for the Plex scanner to.')
+    parser.add_argument('--stat-ttl',
+                        dest='stat_ttl', type=float,
+                        default=None,
+                        help='How many seconds to reuse file stats from the root for '
+                             '(for network filesystems).')
+    parser.add_argument('--listdir-ttl',
+                        dest='listdir_ttl', type=float,
+                        default=None,
+                        help='How many seconds to reuse directory listings from the root for.')
+    parser.add_argument('--statvfs-ttl',
+                        dest='statvfs_ttl', type=float,
+                        default=None,
+                        help='How many seconds to reuse filesystem stats from the root for.')
+    parser.add_argument('-r', '--random-access',
+                        dest='random_access', action='store_true',
+                        help='Decode only the parts of WAV tracks that are read.')
+    parser.add_argument('--window-seconds',
+                        dest='window_seconds', type=float,
+                        default=5,
+                        help='With --random-access, the seconds of audio decoded at a time.')
+    parser.add_argument('--window-cache-size',
+                        dest='window_cache_size', type=int,
+                        default=64,
+                        help='With --random-access, the maximum number of decoded windows '
+                             'to keep in memory.')
+    parser.add_argument('--window-cache-mb',
+                        dest='window_cache_mb', type=float,
+                        default=128,
+                        help='With --random-access, the maximum megabytes (MiB) of decoded '
+                             'windows to keep in memory.')
+    parser.add_argument('--split-frames',
+                        dest='split_frames', action='store_true',
+                        help='With --format flac, copy the frames of FLAC files instead of '
+                             're-encoding tracks.')
+    parser.add_argument('--decode-workers',
+                        dest='decode_workers', type=int,
+                        default=2,
+                        help='The maximum number of tracks to extract at once.')
+    parser.add_argument('--bulk-process',
+                        dest='bulk_processes', type=str, action='append',
+                        default=None,
+                        help='A process name whose tracks are extracted after playback '
+                             '(default: "Plex Media Scan"). May be given more than once.')
+    parser.add_argument('--attr-timeout',
+                        dest='attr_timeout', type=float,
+                        default=1,
+                        help='How many seconds the kernel caches file attributes for.')
+    parser.add_argument('--entry-timeout',
+                        dest='entry_timeout', type=float,
+                        default=1,
+                        help='How many seconds the kernel caches filename lookups for.')
+    parser.add_argument('--no-keep-cache',
+                        dest='keep_cache', action='store_false',
+                        help='Drop the kernel page cache of split tracks each time they are opened.')
     parser.add_argument('-v', '--verbose',
                         dest='verbose', action='store_true',
                         help='Whether to print verbose messages.')
     args = parser.parse_args()
 
-    fuse_obj = fuse.FUSE(FLACCue(args.root, args.mount, format=args.format, verbose=args.verbose),
-                         args.mount, foreground=True, allow_other=True)
+    flaccue = FLACCue(args.root, args.mount, format=args.format,
+                      cue_cache_size=args.cue_cache_size,
+                      dir_cache_size=args.dir_cache_size,
+                      negative_cache_size=args.negative_cache_size,
+                      negative_ttl=args.negative_ttl,
+                      attr_cache_size=args.attr_cache_size,
+                      attr_ttl=args.attr_ttl,
+                      info_cache_size=args.info_cache_size,
+                      size_cache_size=args.size_cache_size,
+                      node_cache_size=args.node_cache_size,
+                      index=args.index, preindex=args.preindex,
+                      preindex_workers=args.preindex_workers,
+                      preindex_nice=args.preindex_nice, watch=args.watch,
+                      manifest_dir=args.manifest_dir, keep_cache=args.keep_cache,
+                      stat_ttl=args.stat_ttl, listdir_ttl=args.listdir_ttl,
+                      statvfs_ttl=args.statvfs_ttl, random_access=args.random_access,
+                      window_seconds=args.window_seconds,
+                      window_cache_size=args.window_cache_size,
+                      window_cache_mb=args.window_cache_mb,
+                      split_frames=args.split_frames, decode_workers=args.decode_workers,
+                      bulk_processes=args.bulk_processes or ('Plex Media Scan',),
+                      verbose=args.verbose)
+
+    # Print the cache counters on request with "kill -USR1".
+    def print_stats(signum, frame):
+        print(flaccue.cache_stats(), flush=True)
+    signal.signal(signal.SIGUSR1, print_stats)
+
+    fuse_obj = fuse.FUSE(flaccue, args.mount, foreground=True, allow_other=True, raw_fi=True,
+                         use_ino=True,
+                         attr_timeout=args.attr_timeout, entry_timeout=args.entry_timeout)